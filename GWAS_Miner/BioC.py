@@ -82,21 +82,18 @@ def get_bioc_annotations(doc, used_annots, offset, t, m, p, r, table_elem_id=Non
 
 
 class BioCNode:
-    refid = None
-    role = None
+    __slots__ = ("refid", "role")
 
     def __init__(self, refid=None, role=None):
         self.refid = refid
         self.role = role
 
     def jsonable(self):
-        return self.__dict__
+        return {"refid": self.refid, "role": self.role}
 
 
 class BioCRelation:
-    id = None
-    infons = None
-    nodes = None
+    __slots__ = ("id", "infons", "nodes")
 
     def __init__(self, id=None, infons=None, nodes=None):
         if infons is None:
@@ -108,14 +105,11 @@ class BioCRelation:
         self.nodes = nodes
 
     def jsonable(self):
-        return self.__dict__
+        return {"id": self.id, "infons": self.infons, "nodes": self.nodes}
 
 
 class BioCLocation:
-    offset = None
-    length = None
-    table_element = None
-    cell_id = None
+    __slots__ = ("offset", "length", "table_element", "cell_id")
 
     def __init__(self, offset=None, length=None, table_element=None, table_cell_id=None):
         self.offset = offset
@@ -124,10 +118,12 @@ class BioCLocation:
         self.cell_id = table_cell_id
 
     def jsonable(self):
-        return self.__dict__
+        return {"offset": self.offset, "length": self.length, "table_element": self.table_element,
+                "cell_id": self.cell_id}
 
 
 class BioCAnnotation:
+    __slots__ = ("text", "infons", "id", "locations")
 
     def __init__(self, id=None, infons=None, locations=None, text=None):
         self.text = text
@@ -136,15 +132,11 @@ class BioCAnnotation:
         self.locations = locations
 
     def jsonable(self):
-        return self.__dict__
+        return {"text": self.text, "infons": self.infons, "id": self.id, "locations": self.locations}
 
 
 class BioCSentence:
-    infons = None
-    offset = None
-    text = None
-    annotations = None
-    relations = None
+    __slots__ = ("infons", "offset", "text", "annotations", "relations")
 
     def __init__(self, infons=None, offset=None, text=None, annotations=None, relations=None):
         self.infons = infons
@@ -154,32 +146,29 @@ class BioCSentence:
         self.relations = relations
 
     def jsonable(self):
-        return self.__dict__
+        return {"infons": self.infons, "offset": self.offset, "text": self.text, "annotations": self.annotations,
+                "relations": self.relations}
 
 
 class BioCPassage:
-    infons = None
-    offset = None
-    text = None
-    sentences = None
-    annotations = None
-    relations = None
+    __slots__ = ("infons", "offset", "text", "sentences", "annotations", "relations")
 
     def __init__(self, infons=None, offset=None, text=None, sentences=None, annotations=None, relations=None):
         self.infons = infons
         self.offset = offset
+        # Passage text is not stored or written, the output passages only hold their annotations and relations.
+        self.text = None
         self.sentences = sentences
         self.annotations = annotations
         self.relations = relations
 
     def jsonable(self):
-        return self.__dict__
+        return {"infons": self.infons, "offset": self.offset, "sentences": self.sentences,
+                "annotations": self.annotations, "relations": self.relations}
 
 
 class BioCDocument:
-    id = None
-    infons = None
-    passages = None
+    __slots__ = ("id", "infons", "passages")
 
     def __init__(self, id=None, infons=None, passages=None):
         self.id = id
@@ -187,15 +176,11 @@ class BioCDocument:
         self.passages = passages
 
     def jsonable(self):
-        return self.__dict__
+        return {"id": self.id, "infons": self.infons, "passages": self.passages}
 
 
 class BioCCollection:
-    source = None
-    date = None
-    key = None
-    infons = None
-    documents = None
+    __slots__ = ("source", "date", "key", "infons", "documents")
 
     def __init__(self, source=None, date=None, key=None, infons=None, documents=None):
         self.source = source
@@ -205,7 +190,26 @@ class BioCCollection:
         self.documents = documents
 
     def jsonable(self):
-        return self.__dict__
+        return {"source": self.source, "date": self.date, "key": self.key, "infons": self.infons,
+                "documents": self.documents}
+
+
+def to_builtin(obj):
+    """
+    Convert BioC objects nested within dictionaries and lists into plain dictionaries and lists, so the whole
+    structure can be encoded by the JSON encoder without a default handler call for each object.
+    @param obj: Value to convert.
+    @return: Value containing only dictionaries, lists and JSON scalar types.
+    """
+    if obj is None or isinstance(obj, (str, int, float)):
+        return obj
+    if isinstance(obj, dict):
+        return {key: to_builtin(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_builtin(x) for x in obj]
+    if hasattr(obj, 'jsonable'):
+        return to_builtin(obj.jsonable())
+    raise TypeError('Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj)))
 
 
 def ComplexHandler(Obj):
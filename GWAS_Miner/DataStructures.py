@@ -1,8 +1,17 @@
 import logging
+import math
+import random
 import re
 
+import config
+
 logger = logging.getLogger("GWAS Miner")
 
+# Patterns used to type table body cells.
+rsid_cell_pattern = re.compile(r"(?:rs[0-9]{1,}){1}", re.IGNORECASE)
+integer_cell_pattern = re.compile(r"(^[0-9]{1,}[ ]?$)", re.IGNORECASE)
+p_val_cell_pattern = re.compile(r"(\d+\.?\d?[ ]?[×xX*][ ]?\d+-\d[\(]?\d?[\)]?)|(\d\.\d+ ?)$", re.IGNORECASE)
+
 
 def convert_to_list(num):
     result = []
@@ -174,6 +183,7 @@ class Table:
         self.rows = self.__get_rows()
         self.columns = [x for x in self.data["columns"]]
         self.target_indexes = None
+        self.column_type_confidence = {}
         self.__text = self.__convert_to_text()
 
     def __get_rows(self):
@@ -192,60 +202,101 @@ class Table:
         self.targets = targets
         self.target_indexes = Table.__get_target_headings(table=self.data, target_headings=self.targets)
 
+    @staticmethod
+    def __get_cell_type(cell_value):
+        if rsid_cell_pattern.search(cell_value):
+            return "marker"
+        elif integer_cell_pattern.fullmatch(cell_value):
+            return "integer"
+        elif p_val_cell_pattern.search(cell_value):
+            return "p_val"
+        elif not cell_value.replace(" ", ""):
+            return "blank"
+        return "phenotype"
+
+    @staticmethod
+    def __sample_column_type(column, cell_type, threshold):
+        """
+        Estimate whether a column exceeds the threshold from a stratified sample of its rows. The column is split into
+        equal strata and one row is drawn from each, so every section of the table is represented in proportion to its
+        size without aliasing against regularly repeating rows.
+        @param column: List of cell values in the column.
+        @param cell_type: Cell type to count, marker, p_val or phenotype.
+        @param threshold: Percentage of the column's cells which must be of the given type.
+        @return: Tuple of the result (None if the sample is ambiguous) and the (lower, upper) confidence interval of
+        the percentage of cells of the given type.
+        """
+        sample_size = min(config.table_sample_size, len(column))
+        generator = random.Random(len(column))  # Seeded so repeated runs type the table identically.
+        sample = [column[generator.randrange((x * len(column)) // sample_size, ((x + 1) * len(column)) // sample_size)]
+                  for x in range(sample_size)]
+        proportion = len([x for x in sample if Table.__get_cell_type(str(x)) == cell_type]) / sample_size
+        # Wilson score interval, which remains valid when the sample proportion is 0 or 1.
+        z = config.table_sample_z_score
+        centre = (proportion + z * z / (2 * sample_size)) / (1 + z * z / sample_size)
+        margin = z * math.sqrt(proportion * (1 - proportion) / sample_size + z * z / (4 * sample_size * sample_size)) \
+            / (1 + z * z / sample_size)
+        interval = ((centre - margin) * 100, (centre + margin) * 100)
+        if interval[0] > threshold:
+            return True, interval
+        elif interval[1] <= threshold:
+            return False, interval
+        return None, interval
+
+    def __is_column_type(self, index, column, cell_type, threshold):
+        """
+        Check whether more than the threshold percentage of a column's cells are of the given type. Large columns are
+        decided from a sample of rows when the sample is conclusive, recording the confidence interval in
+        column_type_confidence. Otherwise cells are tested until the outcome is certain.
+        @param index: Column index.
+        @param column: List of cell values in the column.
+        @param cell_type: Cell type to count, marker, p_val or phenotype.
+        @param threshold: Percentage of the column's cells which must be of the given type.
+        @return: True if the column exceeds the threshold.
+        """
+        if config.table_sample_min_rows and len(column) > config.table_sample_min_rows:
+            result, interval = Table.__sample_column_type(column, cell_type, threshold)
+            if result is not None:
+                self.column_type_confidence[index] = interval
+                return result
+        cell_weight = 100 / len(column)
+        count = 0
+        for remaining in range(len(column) - 1, -1, -1):
+            if Table.__get_cell_type(str(column[len(column) - 1 - remaining])) == cell_type:
+                count += 1
+                if count * cell_weight > threshold:
+                    return True
+            elif (count + remaining) * cell_weight <= threshold:
+                return False
+        return False
+
     def __get_table_column_types(self):
         valuable_fields = {"Phenotypes": [], "GEE": [], "FBAT": [], "MISC_PVAL": [], "marker": []}
         acceptable_threshold = 80
-        value_test_count = len(self.rows)
         data = [x for x in [i for i in self.columns] if x]
         if not data:
             return valuable_fields
+        if not self.rows:
+            return None
         for i in range(len(self.columns)):
             if self.columns[i] == '' or self.columns[i].count(self.columns[i][0]) == len(self.columns[i]):
                 continue
-            #  Test each body cell value in column
-            rsid_count = 0  # Contains RSID, should be a marker column.
-            phenotype_count = 0  # High chance of being a phenotype descriptor of some sort.
-            integer_count = 0  # Likely to be a quantity or other non-desirable value
-            p_val_count = 0  # Likely to contain a p-value
-            blank_cells = 0
-            for o in range(value_test_count):
-                cell_value = str(self.rows[o][i])
-                if re.search(r"(?:rs[0-9]{1,}){1}", cell_value, re.IGNORECASE):
-                    rsid_count += 1
-                elif re.fullmatch(r"(^[0-9]{1,}[ ]?$)", cell_value, re.IGNORECASE):
-                    integer_count += 1
-                elif re.search(r"(\d+\.?\d?[ ]?[×xX*][ ]?\d+-\d[\(]?\d?[\)]?)|(\d\.\d+ ?)$",
-                               cell_value, re.IGNORECASE):
-                    p_val_count += 1
-                elif not cell_value.replace(" ", ""):
-                    blank_cells += 1
-                else:
-                    phenotype_count += 1
-            tested_cells = value_test_count - blank_cells
-            is_rsid = False
-            is_phenotype = False
-            is_p_val = False
-            if tested_cells > 0:
-                is_rsid = (rsid_count * (100 / value_test_count)) > acceptable_threshold
-                is_phenotype = (phenotype_count * (100 / value_test_count)) > acceptable_threshold
-                is_p_val = (p_val_count * (100 / value_test_count)) > acceptable_threshold
+            # Only the cell type relevant to the column heading is tested.
             heading = self.columns[i].lower()
             if "marker" in heading:
-                if is_rsid:
-                    valuable_fields["marker"].append(i)
+                field, cell_type = "marker", "marker"
             elif "gee" in heading:
-                if is_p_val:
-                    valuable_fields["GEE"].append(i)
+                field, cell_type = "GEE", "p_val"
             elif "fbat" in heading:
-                if is_p_val:
-                    valuable_fields["FBAT"].append(i)
+                field, cell_type = "FBAT", "p_val"
             elif "p-val" in heading:
-                if is_p_val:
-                    valuable_fields["MISC_PVAL"].append(i)
+                field, cell_type = "MISC_PVAL", "p_val"
             elif "phenotype" in heading or "trait" in heading:
-                if "p-val" not in heading:
-                    if is_phenotype:
-                        valuable_fields["Phenotypes"].append([i, heading])  # Do not remove heading!
+                field, cell_type = "Phenotypes", "phenotype"
+            else:
+                continue
+            if self.__is_column_type(i, [row[i] for row in self.rows], cell_type, acceptable_threshold):
+                valuable_fields[field].append([i, heading] if field == "Phenotypes" else i)  # Do not remove heading!
         if not valuable_fields["Phenotypes"] or not valuable_fields["marker"]:
             return None
         elif not valuable_fields["GEE"] and not valuable_fields["FBAT"] and not valuable_fields["MISC_PVAL"]:
@@ -258,8 +309,7 @@ class Table:
 
     @staticmethod
     def __strip_pval(text):
-        match = re.search(r"(\d+\.?\d?[ ]?[×xX*][ ]?\d+-\d[\(]?\d?[\)]?)|(\d\.\d+ ?)$", text,
-                          re.IGNORECASE)
+        match = p_val_cell_pattern.search(text)
         if match:
             return match.group()
         else:
@@ -267,7 +317,7 @@ class Table:
 
     @staticmethod
     def __strip_rsid(text):
-        match = re.search(r"(?:rs[0-9]{1,}){1}", text, re.IGNORECASE)
+        match = rsid_cell_pattern.search(text)
         if match:
             return match.group()
         else:
@@ -417,6 +467,8 @@ class MeshTerm:
 
 
 class LexiconEntry:
+    __lexicon = None  # Lexicon containing this entry, notified of name & synonym changes.
+
     def __init__(self, identifer, name, tree_id=None):
         self.identifier = identifer
         self.__name = name
@@ -427,9 +479,16 @@ class LexiconEntry:
     def get_token_size(self):
         return self.__token_size
 
+    def set_lexicon(self, lexicon):
+        self.__lexicon = lexicon
+
     def set_name(self, name):
+        old_name = self.__name
         self.__name = name
         self.__token_size = name.count(" ")
+        if self.__lexicon:
+            self.__lexicon.unindex_term(old_name, self)
+            self.__lexicon.index_term(name, self)
 
     def name(self):
         return self.__name
@@ -437,9 +496,13 @@ class LexiconEntry:
     def add_synonym(self, id, name):
         if name not in [x["name"] for x in self.__synonyms]:
             self.__synonyms.append({"id": id, "name": name})
+            if self.__lexicon:
+                self.__lexicon.index_term(name, self)
 
     def remove_synonym(self, synonym):
         self.__synonyms.remove(synonym)
+        if self.__lexicon:
+            self.__lexicon.unindex_term(synonym["name"], self)
 
     def synonyms(self):
         return self.__synonyms
@@ -451,25 +514,91 @@ class LexiconEntry:
         self.__tree_id.append(tree_id)
 
 
-class Lexicon:
+class BaseLexicon:
+    """
+    Named collection of lexicon entries which can be searched by term or identifier. Lexicon holds its entries in
+    memory and can be edited, while stored lexicons are read-only and do not provide the editing methods.
+    """
+
     def __init__(self, name):
         self.name = name
+
+
+class Lexicon(BaseLexicon):
+    def __init__(self, name):
+        super().__init__(name)
         self.__entries = []
-        self.__identifiers = []
         self.__longest_term = 0
+        self.__build_indexes()
+
+    def __getstate__(self):
+        # The indexes are rebuilt from the entries when unpickled, so they are left out of the pickle.
+        state = self.__dict__.copy()
+        state.pop("_Lexicon__identifiers", None)
+        state.pop("_Lexicon__terms", None)
+        return state
+
+    def __setstate__(self, state):
+        # Rebuilds the indexes, which are not pickled and are missing from lexicons pickled before they existed.
+        self.__dict__.update(state)
+        self.__build_indexes()
+
+    def __build_indexes(self):
+        self.__identifiers = {}  # identifier -> entries
+        self.__terms = {}  # lower-cased name/synonym -> entries
+        for entry in self.__entries:
+            self.__index_entry(entry)
+
+    def __index_entry(self, entry):
+        self.__identifiers.setdefault(entry.identifier, []).append(entry)
+        self.index_term(entry.name(), entry)
+        for syn in entry.synonyms():
+            self.index_term(syn["name"], entry)
+        entry.set_lexicon(self)
+
+    def index_term(self, term, entry):
+        """
+        Add a name or synonym of an entry to the term index.
+        """
+        entries = self.__terms.setdefault(term.lower(), [])
+        if entry not in entries:
+            entries.append(entry)
+
+    def unindex_term(self, term, entry):
+        """
+        Remove a name or synonym of an entry from the term index, unless the entry still uses the term.
+        """
+        term = term.lower()
+        if term == entry.name().lower() or term in [x["name"].lower() for x in entry.synonyms()]:
+            return
+        entries = self.__terms.get(term)
+        if entries and entry in entries:
+            entries.remove(entry)
+            if not entries:
+                del self.__terms[term]
 
     def add_entry(self, entry):
         if isinstance(entry, LexiconEntry):
             self.__entries.append(entry)
             if entry.get_token_size() > self.__longest_term:
                 self.__longest_term = entry.get_token_size()
-            self.__identifiers.append(entry.identifier)
+            self.__index_entry(entry)
         else:
             raise TypeError("entry input must be of type LexiconEntry")
 
     def remove_entry(self, entry):
         if isinstance(entry, LexiconEntry):
             self.__entries.remove(entry)
+            self.__identifiers[entry.identifier].remove(entry)
+            if not self.__identifiers[entry.identifier]:
+                del self.__identifiers[entry.identifier]
+            for term in [entry.name()] + [x["name"] for x in entry.synonyms()]:
+                entries = self.__terms.get(term.lower())
+                if entries and entry in entries:
+                    entries.remove(entry)
+                    if not entries:
+                        del self.__terms[term.lower()]
+            entry.set_lexicon(None)
         else:
             raise TypeError("entry input must be of type LexiconEntry")
 
@@ -480,51 +609,53 @@ class Lexicon:
         return identifier in self.__identifiers
 
     def assign_synonym(self, identifier, name):
-        entry = next((x for x in self.__entries if x.identifier == identifier), None)
+        entry = self.get_entry_by_id(identifier)
         if entry:
-            entry.add_synonym(name)
+            entry.add_synonym(identifier, name)
 
     def get_entry_by_term(self, term):
-        term = term.lower()
-        for entry in self.__entries:
-            if entry.name().lower() == term:
-                return entry
-            if term in [x["name"].lower() for x in entry.synonyms()]:
-                return entry
-        return None
+        entries = self.__terms.get(term.lower())
+        return entries[0] if entries else None
 
     def get_entry_by_id(self, ident):
-        for entry in self.__entries:
-            if entry.identifier == ident:
-                return entry
-        return None
+        entries = self.__identifiers.get(ident)
+        return entries[0] if entries else None
 
 
 class MasterLexicon:
     def __init__(self):
         self.__lexicons = []
+        self.__lexicon_names = {}
         self.__priority_order = {}
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lexicon_names = {}
+        for lexicon in self.__lexicons:
+            self.__lexicon_names.setdefault(lexicon.name, lexicon)
+
     def add_lexicon(self, new_lexicon):
-        if isinstance(new_lexicon, Lexicon):
+        if isinstance(new_lexicon, BaseLexicon):
             if new_lexicon not in self.__lexicons:
                 self.__lexicons.append(new_lexicon)
+                self.__lexicon_names.setdefault(new_lexicon.name, new_lexicon)
             else:
                 logger.info("Lexicon already present in MasterLexicon object.")
 
     def remove_lexicon(self, target_lexicon):
-        if not isinstance(target_lexicon, Lexicon):
+        if not isinstance(target_lexicon, BaseLexicon):
             raise TypeError("Input must be of type Lexicon")
         for lexicon in self.__lexicons:
             if lexicon is target_lexicon:
                 self.__lexicons.remove(lexicon)
+                self.__lexicon_names = {}
+                for remaining in self.__lexicons:
+                    self.__lexicon_names.setdefault(remaining.name, remaining)
                 return True
         return False
 
     def get_lexicon_by_name(self, name):
-        for lexicon in self.__lexicons:
-            if lexicon.name == name:
-                return lexicon
+        return self.__lexicon_names.get(name)
 
     def set_priority_order(self, new_priority):
         """
@@ -0,0 +1,101 @@
+class DependencyTree:
+    """
+    Dependency parse of a sentence stored as an array of integer head positions, for answering shortest dependency
+    path queries without building a graph. The parse is a tree, so the shortest path between two tokens always passes
+    through their lowest common ancestor and its length follows from the token depths.
+
+    Nodes are the tokens of the sentence joined to a head or child by a dependency arc, named "text<id{char index}>".
+    """
+
+    def __init__(self, sent):
+        self.nodes = {}  # Node name -> position
+        self.token_indexes = {}  # Token character index -> document token index
+        self.__heads = []
+        self.__depths = []
+        self.__roots = []
+        parents = {}
+        for token in sent:
+            for child in token.children:
+                self.__add_node(token)
+                self.__add_node(child)
+                parents[self.nodes[self.get_node_name(child)]] = self.nodes[self.get_node_name(token)]
+        self.__heads = [parents.get(x, -1) for x in range(len(self.nodes))]
+        self.__depths = [-1] * len(self.__heads)
+        self.__roots = [-1] * len(self.__heads)
+        for position in range(len(self.__heads)):
+            self.__set_depth(position)
+
+    @staticmethod
+    def get_node_name(token):
+        return F"{token}<id{token.idx}>"
+
+    def __add_node(self, token):
+        name = self.get_node_name(token)
+        if name not in self.nodes:
+            self.nodes[name] = len(self.nodes)
+            self.token_indexes[token.idx] = token.i
+
+    def __set_depth(self, position):
+        # Walk up to the nearest node with a known depth, then fill in the depths on the way back down.
+        path = []
+        while position != -1 and self.__depths[position] == -1:
+            path.append(position)
+            position = self.__heads[position]
+        depth = self.__depths[position] if position != -1 else -1
+        root = self.__roots[position] if position != -1 else path[-1]
+        for node in reversed(path):
+            depth += 1
+            self.__depths[node] = depth
+            self.__roots[node] = root
+
+    def __distance(self, source, target):
+        if self.__roots[source] != self.__roots[target]:
+            return None
+        distance = 0
+        while self.__depths[source] > self.__depths[target]:
+            source = self.__heads[source]
+            distance += 1
+        while self.__depths[target] > self.__depths[source]:
+            target = self.__heads[target]
+            distance += 1
+        while source != target:
+            source = self.__heads[source]
+            target = self.__heads[target]
+            distance += 2
+        return distance
+
+    def get_distance(self, source, target):
+        """
+        Calculate the number of dependency arcs on the shortest path between two nodes.
+        @param source: Name of the source node.
+        @param target: Name of the target node.
+        @return: Path length, or None if either node is not in the tree or no path joins them.
+        """
+        if source not in self.nodes or target not in self.nodes:
+            return None
+        return self.__distance(self.nodes[source], self.nodes[target])
+
+    def get_distances(self, source, targets):
+        """
+        Calculate the shortest path lengths from one node to each of the target nodes. The ancestors of the source are
+        found once and each target only walks up until it meets one of them.
+        @param source: Name of the source node.
+        @param targets: Names of the target nodes.
+        @return: List of path lengths in the order of the targets, None where no path exists.
+        """
+        if source not in self.nodes:
+            return [None for x in targets]
+        ancestors = {}
+        position = self.nodes[source]
+        while position != -1:
+            ancestors[position] = len(ancestors)
+            position = self.__heads[position]
+        distances = []
+        for target in targets:
+            position = self.nodes.get(target, -1)
+            steps = 0
+            while position != -1 and position not in ancestors:
+                position = self.__heads[position]
+                steps += 1
+            distances.append(steps + ancestors[position] if position != -1 else None)
+        return distances
@@ -1,15 +1,19 @@
 import json
+import os
+import tempfile
 from datetime import datetime
 
 import BioC
-from TableExtractor import Table, get_cell_entity_annotation, TableRow, TableSection, TableCell, TablePassage
+import OutputConverter
+from TableExtractor import Table, get_cell_entity_annotation, TableRow, TableSection, TableCell, TablePassage, \
+    add_spacy_docs, iter_collection_documents
 
 table_significance_pattern = r""
 
 
-def process_tables(nlp, tables):
+def process_tables(nlp, tables, n_process=1):
+    nlp = add_spacy_docs(nlp, tables, n_process=n_process)
     for table in tables:
-        nlp = table.add_spacy_docs(nlp)
         if table.table_type:
             nlp = table.get_gc_annotations(nlp)
         table.annotations = nlp.annotations
@@ -19,7 +23,87 @@ def process_tables(nlp, tables):
     return tables, nlp
 
 
-def parse_tables(file_input, nlp):
+def __parse_table_document(doc, file_input):
+    """
+    Build a GCTable object from a BioC table document.
+    @param doc: BioC document dictionary for a single table.
+    @param file_input: Path of the tables file, used for reporting.
+    @return: GCTable object, or None if the table uses the unsupported section title format.
+    """
+    table_id = doc['id']
+    title = None
+    title_offset = None
+    caption = None
+    caption_offset = None
+    content_offset = None
+    columns = []
+    table_sections = []
+    footer = None
+    footer_offset = None
+    doc['annotations'] = []
+    for passage in doc['passages']:
+        table_passage = TablePassage(passage['infons']['section_title_1'])
+        if "section_title_2" in passage['infons'].keys():
+            print(F"Second table title found in: {file_input}")
+        if passage['infons']['section_title_1'] == 'table_title':
+            title = passage['text']
+            title_offset = passage['offset']
+        elif passage['infons']['section_title_1'] == 'table_caption':
+            caption = passage['text']
+            caption_offset = passage['offset']
+        elif passage['infons']['section_title_1'] == 'table_footer':
+            footer = passage['text']
+            footer_offset = passage['offset']
+        elif passage['infons']['section_title_1'] == 'table_content':
+            content_offset = passage['offset']
+            col_row = TableRow()
+            for col in passage['column_headings']:
+                column_cell = TableCell(col['cell_id'], str(col['cell_text']))
+                col_row.cells.append(column_cell)
+            columns.append(col_row)
+            for section in passage['data_section']:
+                if 'table_section_title_1' in section.keys():
+                    return None
+                section_title = section['text'] if 'text' in section.keys() else None
+                title_offset = section['offset'] if section_title else None
+                table_section = TableSection(title=section_title, title_offset=title_offset)
+                for row in section['data_rows']:
+                    data_row = TableRow()
+                    for cell in row:
+                        data_cell = TableCell(cell['cell_id'], str(cell['cell_text']))
+                        data_row.cells.append(data_cell)
+                    if abs(len(data_row.cells) - len(columns[0].cells)) > 1:
+                        print(F"{file_input} contains potentially problematic cell counts!")
+                    table_section.rows.append(data_row)
+                table_sections.append(table_section)
+        table_passage.sections = table_sections
+    return GCTable(title, table_id, title_offset, content_offset, columns,
+                   table_sections, caption, caption_offset, footer, footer_offset)
+
+
+def __add_table_annotations(bioc_table, table):
+    """
+    Split the annotations of a table across the passages of its BioC document.
+    @param bioc_table: BioC document dictionary for the table.
+    @param table: Annotated GCTable object.
+    """
+    element_annotations = {}
+    for annotation in table.annotations:
+        element_annotations.setdefault(annotation.locations[0].table_element, []).append(annotation)
+    node_relations = {}
+    for i, relation in enumerate(table.relations):
+        for node in relation.nodes:
+            node_relations.setdefault(node.refid, set()).add(i)
+    for passage in bioc_table["passages"]:
+        passage["annotations"] = list(element_annotations.get(passage['infons']['section_title_1'], []))
+        used_ids = {x.id for x in passage["annotations"]}
+        relation_indexes = set()
+        for refid in used_ids:
+            relation_indexes.update(node_relations.get(refid, ()))
+        passage["relations"] = [table.relations[i] for i in sorted(relation_indexes)]
+
+
+def parse_tables(file_input, nlp, n_process=1):
     tables = []
     tables_data = None
     contains_annotations = False
@@ -27,80 +111,79 @@ def parse_tables(file_input, nlp):
         with open(file_input, "r", encoding="utf-8") as fin:
             tables_data = json.load(fin)
         for doc in tables_data["documents"]:  # each doc is a table
-            table_id = doc['id']
-            title = None
-            title_offset = None
-            caption = None
-            caption_offset = None
-            content_offset = None
-            columns = []
-            table_sections = []
-            footer = None
-            footer_offset = None
-            doc['annotations'] = []
-            for passage in doc['passages']:
-                table_passage = TablePassage(passage['infons']['section_title_1'])
-                if "section_title_2" in passage['infons'].keys():
-                    print(F"Second table title found in: {file_input}")
-                if passage['infons']['section_title_1'] == 'table_title':
-                    title = passage['text']
-                    title_offset = passage['offset']
-                elif passage['infons']['section_title_1'] == 'table_caption':
-                    caption = passage['text']
-                    caption_offset = passage['offset']
-                elif passage['infons']['section_title_1'] == 'table_footer':
-                    footer = passage['text']
-                    footer_offset = passage['offset']
-                elif passage['infons']['section_title_1'] == 'table_content':
-                    content_offset = passage['offset']
-                    col_row = TableRow()
-                    for col in passage['column_headings']:
-                        column_cell = TableCell(col['cell_id'], str(col['cell_text']))
-                        col_row.cells.append(column_cell)
-                    columns.append(col_row)
-                    for section in passage['data_section']:
-                        if 'table_section_title_1' in section.keys():
-                            return None, False
-                        section_title = section['text'] if 'text' in section.keys() else None
-                        title_offset = section['offset'] if section_title else None
-                        table_section = TableSection(title=section_title, title_offset=title_offset)
-                        for row in section['data_rows']:
-                            data_row = TableRow()
-                            for cell in row:
-                                data_cell = TableCell(cell['cell_id'], str(cell['cell_text']))
-                                data_row.cells.append(data_cell)
-                            if abs(len(data_row.cells) - len(columns[0].cells)) > 1:
-                                print(F"{file_input} contains potentially problematic cell counts!")
-                            table_section.rows.append(data_row)
-                        table_sections.append(table_section)
-                table_passage.sections = table_sections
-            table = GCTable(title, table_id, title_offset, content_offset, columns,
-                            table_sections, caption, caption_offset, footer, footer_offset)
+            table = __parse_table_document(doc, file_input)
+            if table is None:
+                return None, False
             tables.append(table)
     except IOError:
         print(F"No tables file found for {file_input.replace('_tables.json', '')}")
     if tables_data:
-        annotated_tables, nlp = process_tables(nlp, tables)
+        annotated_tables, nlp = process_tables(nlp, tables, n_process)
+        documents_by_id = {}
+        for bioc_table in tables_data["documents"]:
+            documents_by_id.setdefault(bioc_table["id"], []).append(bioc_table)
         for table in annotated_tables:
             if table.annotations:
                 contains_annotations = True
-                for bioc_table in tables_data["documents"]:
-                    if bioc_table["id"] == table.table_id:
-                        for passage in bioc_table["passages"]:
-                            passage["annotations"] = []
-                            used_ids = []
-                            passage["relations"] = []
-                            for annotation in table.annotations:
-                                if annotation.locations[0].table_element == passage['infons']['section_title_1']:
-                                    passage["annotations"].append(annotation)
-                                    used_ids.append(annotation.id)
-                            for relation in table.relations:
-                                if [x for x in relation.nodes if x.refid in used_ids]:
-                                    passage["relations"].append(relation)
-                    bioc_table["relations"] = []
+                for bioc_table in documents_by_id.get(table.table_id, []):
+                    __add_table_annotations(bioc_table, table)
+        if contains_annotations:
+            for bioc_table in tables_data["documents"]:
+                bioc_table["relations"] = []
     return tables_data, contains_annotations
 
 
+def stream_tables(file_input, destination, nlp, n_process=1):
+    """
+    Annotate a tables file one table at a time, writing each table to the output file as soon as it is annotated, so
+    memory use is bounded by the largest table rather than the whole file. The output is written to a temporary file
+    which only replaces the destination if annotations were found.
+    @param file_input: Path of the tables file.
+    @param destination: Output file path.
+    @param nlp: Interpreter object used for NLP processing.
+    @param n_process: Number of processes used by the model.
+    @return: Tuple of the number of tables read (None if the file could not be read or uses an unsupported format)
+    and whether annotations were found.
+    """
+    contains_annotations = False
+    table_count = 0
+    collection = {}
+    temp_path = None
+    try:
+        with open(file_input, "r", encoding="utf-8") as fin, \
+                tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(destination) or ".",
+                                            suffix=".tmp", delete=False) as fout:
+            temp_path = fout.name
+            writer = None
+            for doc in iter_collection_documents(fin, collection):
+                if writer is None:
+                    writer = OutputConverter.BioCJSONWriter(fout, ensure_ascii=False)
+                    writer.start_collection(collection)
+                table = __parse_table_document(doc, file_input)
+                if table is None:
+                    return None, False
+                process_tables(nlp, [table], n_process)
+                table_count += 1
+                if table.annotations:
+                    contains_annotations = True
+                    __add_table_annotations(doc, table)
+                doc["relations"] = []
+                writer.write_document(doc)
+            if writer is None:
+                writer = OutputConverter.BioCJSONWriter(fout, ensure_ascii=False)
+                writer.start_collection(collection)
+            writer.end_collection(collection)
+        if contains_annotations:
+            os.replace(temp_path, destination)
+    except IOError:
+        print(F"No tables file found for {file_input.replace('_tables.json', '')}")
+        table_count = None
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+    return table_count, contains_annotations
+
+
 class GCTable(Table):
 
     def __init__(self, title, table_id, title_offset, content_offset, column_cells, data_sections,
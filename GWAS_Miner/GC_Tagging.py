@@ -1,3 +1,4 @@
+import itertools
 import json
 import os
 import re
@@ -6,27 +7,36 @@ from datetime import datetime
 from os import listdir
 from os.path import isfile, join
 
-import networkx as nx
 import requests
 from spacy.matcher import PhraseMatcher
 from spacy.tokens import Span, Token
 
 import Ontology
+import OutputWriter
+import ResultCache
 from GWAS_Miner import BioC, OutputConverter, Experimental, befree_annotate, GCTableExtractor, TableExtractor
 from GWAS_Miner.DataStructures import Marker, Significance, Phenotype, Association
 from GWAS_Miner.PostProcessing import clean_output_annotations
+from DependencyPaths import DependencyTree
 from NLP import Interpreter
 from Utility_Functions import Utility
 
 
+checkpoint_file = "output/gc_checkpoint.jsonl"
+
+
 class GCInterpreter(Interpreter):
 
     def __init__(self, lexicon, ontology_only=False):
         super().__init__(lexicon, ontology_only)
         self.gc_relations = []
+        self.__ontology_terms = []
+        self.__custom_entities = []
 
     def set_ontology_terms(self, term_ids):
         term_ids = list(set(term_ids))
+        self.__ontology_terms = sorted(term_ids)
+        self.__custom_entities = []
         new_matcher = PhraseMatcher(self.model.vocab, attr="LOWER")
         for lexicon in self.lexicon.get_ordered_lexicons():
             if lexicon.name == "HPO":
@@ -43,10 +53,15 @@ class GCInterpreter(Interpreter):
 
     def set_custom_entities(self, entities: list):
         for label, entity_id in entities:
+            self.__custom_entities.append([label, entity_id])
             label_patterns = Interpreter.get_term_variations(label)
             label_patterns = self.model.tokenizer.pipe(label_patterns)
             self.__phrase_matcher.add(entity_id, label_patterns, on_match=self._Interpreter__on_match)
 
+    def _get_annotation_settings(self, ontology_only=False):
+        return [self.lexicon_version, self.pval_patterns, self.rsid_patterns, self.abbrev_pattens,
+                self.__ontology_terms, self.__custom_entities]
+
     def extract_phenotypes(self, doc):
         """[Extract phenotype to genotype associations from the provided SpaCy doc object]
 
@@ -104,31 +119,27 @@ class GCInterpreter(Interpreter):
                     results.append(new_assoc)
         return results
 
-    def process_corpus(self, corpus, **kwargs):
-        """[Applies tokenization, entity recognition and dependency parsing to the supplied corpus.]
-
-        Args:
-            corpus ([string]): [corpus text for information extraction]
-
-        Returns: [SpaCy doc object]: [Parsed SpaCy doc object containing the processed input text with entities,
-        tokens and dependencies.]
+    def _annotate_doc(self, doc, ontology_only=False):
+        """
+        Apply the study specific regex and ontology matching to a document parsed by the model.
+        @param doc: SpaCy doc object produced by the model.
+        @param ontology_only: Unused, retained for compatibility with Interpreter.
+        @return: SpaCy doc object with merged entities.
         """
-
-        doc = self.model(corpus)
         doc.user_data["relations"] = {"PHENO_ASSOC": []}
 
         old_ents, doc.ents = doc.ents, []
-        for pattern in self.pval_patterns:
-            Interpreter._regex_match(pattern, doc, "PVAL")
+        Interpreter._regex_match(self.pval_patterns, doc, "PVAL")
 
-        for pattern in self.rsid_patterns:
-            Interpreter._regex_match(pattern, doc, "RSID")
+        Interpreter._regex_match(self.rsid_patterns, doc, "RSID")
 
-        for pattern in self.abbrev_pattens:
-            Interpreter._regex_match(pattern[1], doc, pattern[0], ignore_case=False)
+        # Consecutive abbreviation patterns sharing a label are scanned together, preserving their order.
+        for label, patterns in itertools.groupby(self.abbrev_pattens, key=lambda x: x[0]):
+            Interpreter._regex_match([x[1] for x in patterns], doc, label, ignore_case=False)
 
         # self.__basic_matcher(doc)
         self.__phrase_matcher(doc)
+        self._Interpreter__resolve_matches(doc)
 
         # Ensure that rule-matched entities override data model entities when needed.
         for ent in old_ents:
@@ -154,30 +165,20 @@ class GCInterpreter(Interpreter):
         results = []
         # Iterate through each sentence containing a phenotype named entity label
         for sent in phenotype_sents:
-            edges = []
-            token_indexes = {}
-            for token in sent:
-                for child in token.children:
-                    # Add unique id to token strings.
-                    token_text = F"{token}<id{token.idx}>"
-                    child_text = F"{child}<id{child.idx}>"
-                    if token.idx not in token_indexes.keys():
-                        token_indexes[token.idx] = token.i
-                    if child.idx not in token_indexes.keys():
-                        token_indexes[child.idx] = child.i
-                    edges.append(('{0}'.format(token_text),
-                                  '{0}'.format(child_text)))
-
-            graph = nx.Graph(edges)
+            tree = DependencyTree(sent)
+            token_indexes = tree.token_indexes
             phenotypes = [x for x in sent.ents if x._.has_trait]
             phenotypes = [x for x in phenotypes if type(x) == Span]
             phenotypes = Interpreter._validate_node_entities(
-                phenotypes, graph.nodes) if not top_phenotype else None
+                phenotypes, tree.nodes) if not top_phenotype else None
+            # Each phenotype is measured from the node of its first token.
+            phenotype_nodes = [x[1] if type(x[0]) == Token else DependencyTree.get_node_name(x[0][0])
+                               for x in phenotypes] if phenotypes else []
 
             markers = Interpreter._validate_node_entities(
-                [x for x in sent.ents if x.label_ == 'RSID' or x.label_ == "GENE"], graph.nodes)
+                [x for x in sent.ents if x.label_ == 'RSID' or x.label_ == "GENE"], tree.nodes)
             pvals = Interpreter._validate_node_entities(
-                [x for x in sent.ents if x.label_ == 'PVAL'], graph.nodes)
+                [x for x in sent.ents if x.label_ == 'PVAL'], tree.nodes)
 
             relations = []
 
@@ -193,24 +194,12 @@ class GCInterpreter(Interpreter):
 
                             best_pheno_distance = None
                             best_pheno = None
-                            for phenotype in phenotypes:
-                                is_token = type(phenotype[0]) == Token
-                                if is_token:
-                                    temp_distance = nx.shortest_path_length(
-                                        graph, target=phenotype[1], source=significance)
-                                else:
-                                    temp_distance = nx.shortest_path_length(
-                                        graph, target=F"{phenotype[0][0].text}<id{phenotype[0][0].idx}>",
-                                        source=significance)
-
+                            pheno_distances = tree.get_distances(significance, phenotype_nodes)
+                            for phenotype_node, temp_distance in zip(phenotype_nodes, pheno_distances):
+                                if temp_distance is None:
+                                    continue
                                 if not best_pheno_distance or temp_distance < best_pheno_distance:
-                                    if is_token:
-                                        best_pheno = nx.shortest_path(
-                                            graph, target=phenotype[1], source=significance)[-1]
-                                    else:
-                                        best_pheno = nx.shortest_path(
-                                            graph, target=F"{phenotype[0][0].text}<id{phenotype[0][0].idx}>",
-                                            source=significance)[-1]
+                                    best_pheno = phenotype_node
                                     best_pheno_distance = temp_distance
                                 else:
                                     continue
@@ -307,7 +296,38 @@ def get_relation(relation, passage, nlp):
     return bioc_relation, nlp
 
 
-def process_study(nlp, study):
+def get_study_output_files(study):
+    """
+    Get the BioC JSON and XML output file paths of a study.
+    @param study: BioC collection dictionary.
+    @return: Dictionary of the output file paths, keyed by the output_study argument names.
+    """
+    return {"json_file": F"output/json/{study['documents'][0]['id']}_bioc.json",
+            "xml_file": F"output/xml/{study['documents'][0]['id']}_bioc.xml"}
+
+
+def write_study_outputs(checkpoint, pmc_id, status, time_taken, study, tables=None):
+    """
+    Write the outputs of a study followed by its checkpoint. Both are written by one task, so a study whose outputs
+    could not be written is never checkpointed and is processed again when resuming.
+    @param checkpoint: Checkpoint file opened for appending.
+    @param pmc_id: PMC id of the study.
+    @param status: complete or failed.
+    @param time_taken: Processing time in seconds.
+    @param study: Annotated BioC collection dictionary.
+    @param tables: Annotated BioC tables collection dictionary, or None if there are no tables to write.
+    """
+    try:
+        OutputConverter.output_study(study, **get_study_output_files(study))
+    except Exception as e:
+        print(F"Unable to write the output for {pmc_id}: {e}")
+        return
+    if tables and not TableExtractor.output_tables(F"output/{pmc_id}_tables.json", tables):
+        return
+    save_checkpoint(checkpoint, pmc_id, status, time_taken)
+
+
+def process_study(nlp, study, write_output=True):
     if not study:
         return False
     current_datetime = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -320,14 +340,12 @@ def process_study(nlp, study):
         if "section_title_1" in passage["infons"].keys() and passage["infons"]["section_title_1"].lower() == "results":
             results_present = True
             break
-    for passage in study['documents'][0]['passages']:
-        # footnotes need to be excluded.
-        if results_present and "section_title_1" in passage["infons"].keys() and \
-                passage["infons"]["section_title_1"].lower() not in ["abstract", "results",
-                                                                     "discussion", "conclusion"]:
-            continue
+    # footnotes need to be excluded.
+    passages = [x for x in study['documents'][0]['passages'] if not results_present or
+                "section_title_1" not in x["infons"].keys() or
+                x["infons"]["section_title_1"].lower() in ["abstract", "results", "discussion", "conclusion"]]
+    for passage, doc in zip(passages, nlp.process_corpora([x['text'] for x in passages])):
         passage_text = passage['text']
-        doc = nlp.process_corpus(passage_text)
         top_phenotype = nlp.get_ubiquitous_phenotype(passage_text, nlp)
         doc.user_data["top_phenotype"] = top_phenotype
         annotations = nlp.get_entities(doc)
@@ -382,9 +400,8 @@ def process_study(nlp, study):
         study['documents'][0]['relations'] += [x for x in document_relations if x]
 
     study = clean_output_annotations(study)
-    OutputConverter.output_xml(json.dumps(study, default=BioC.ComplexHandler),
-                               F"output/xml/{study['documents'][0]['id']}_bioc.xml")
-    OutputConverter.output_json(study, F"output/json/{study['documents'][0]['id']}_bioc.json")
+    if write_output:
+        OutputConverter.output_study(study, **get_study_output_files(study))
     return study, nlp
 
 
@@ -508,7 +525,52 @@ def download_bioc_articles(pubmedcentral_ids):
             print(F"{id} failed due to: {ex}")
 
 
+def load_checkpoint(file_path):
+    """
+    Read the per-study outcomes saved by a previous run.
+    @param file_path: Checkpoint file path.
+    @return: Tuple of the set of finished PMC ids, the failed PMC ids and the study processing times.
+    """
+    finished, failed_documents, study_processing_times = set(), [], []
+    try:
+        with open(file_path, "r", encoding="utf-8") as f_in:
+            for line in f_in:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Incomplete final line from an interrupted run.
+                finished.add(entry["pmc_id"])
+                if entry["status"] == "failed":
+                    failed_documents.append(entry["pmc_id"])
+                if entry["time"] is not None:
+                    study_processing_times.append((entry["pmc_id"], entry["time"]))
+    except FileNotFoundError:
+        print(F"No checkpoint found at {file_path}, starting from the first study.")
+    return finished, failed_documents, study_processing_times
+
+
+def save_checkpoint(f_out, pmc_id, status, time_taken=None):
+    """
+    Append the outcome of a study to the checkpoint file, flushing it to disk before continuing.
+    @param f_out: Checkpoint file opened for appending.
+    @param pmc_id: PMC id of the study.
+    @param status: complete, failed or skipped.
+    @param time_taken: Processing time in seconds.
+    """
+    f_out.write(json.dumps({"pmc_id": pmc_id, "status": status, "time": time_taken}) + "\n")
+    f_out.flush()
+    os.fsync(f_out.fileno())
+
+
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='GWAS Catalog gold standard tagging')
+    parser.add_argument('--cache', action='store_true', help='Reuse passages processed by previous runs with the same '
+                                                             'model, lexicon and patterns.')
+    parser.add_argument('--resume', action='store_true', help='Continue from the checkpoint saved by an interrupted '
+                                                              'run.')
+    args = parser.parse_args()
+
     # load bioc pmc ids
     bioc_pmcids = [x.replace(".json", "").replace("_abbreviations", "").replace("_bioc", "") for x in listdir("BioC_Studies") if
                    isfile(join("BioC_Studies", x))]
@@ -518,69 +580,98 @@ def main():
 
     lexicon = Ontology.get_master_lexicon()
     nlp = GCInterpreter(lexicon)
+    if args.cache:
+        nlp.result_cache = ResultCache.PassageCache()
     failed_documents = []
     study_processing_times = []
+    finished = set()
+    if args.resume:
+        finished, failed_documents, study_processing_times = load_checkpoint(checkpoint_file)
+    if os.path.dirname(checkpoint_file):
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    checkpoint = open(checkpoint_file, "a" if args.resume else "w", encoding="utf-8")
+    # Outputs and checkpoints are written on a background thread, with each checkpoint saved by the task writing the
+    # outputs of its study.
+    output_writer = OutputWriter.BackgroundWriter()
     reached = False
-    for pmc_id in gc_data.keys():
-        gwas_catalog_data = get_catalog_relations(gc_data[pmc_id][0][3])
-        # print(pmc_id)
-        start_time = datetime.now()
-        pvals = []
-        rsids = []
-        mesh_terms = []
-        gc_relations = []
-        nlp.reset_annotation_identifiers()
-        mesh_id = ""
-        for relation in gc_data[pmc_id]:
-            rsid = relation[0]
-            mesh_id = relation[2]
-            new_pvals = generate_pval_regex_strings(relation[1])
-            pvals.extend(new_pvals)
-            rsids.append(F"({rsid})")
-            mesh_terms.append(mesh_id)
-            for x in new_pvals:
-                gc_relations.append([x, rsid, mesh_id])
-            if len(gc_data[pmc_id]) > 10:
-                break
-        if gwas_catalog_data:
-            for catalog_relation in gwas_catalog_data:
-                rsid = catalog_relation[0]
-                new_pvals = generate_pval_regex_strings(catalog_relation[1])
+    try:
+        for pmc_id in gc_data.keys():
+            if pmc_id in finished:
+                continue
+            gwas_catalog_data = get_catalog_relations(gc_data[pmc_id][0][3])
+            # print(pmc_id)
+            start_time = datetime.now()
+            pvals = []
+            rsids = []
+            mesh_terms = []
+            gc_relations = []
+            nlp.reset_annotation_identifiers()
+            mesh_id = ""
+            for relation in gc_data[pmc_id]:
+                rsid = relation[0]
+                mesh_id = relation[2]
+                new_pvals = generate_pval_regex_strings(relation[1])
                 pvals.extend(new_pvals)
                 rsids.append(F"({rsid})")
+                mesh_terms.append(mesh_id)
                 for x in new_pvals:
                     gc_relations.append([x, rsid, mesh_id])
-        nlp.set_ontology_terms([x for x in mesh_terms if x])
-        nlp.pval_patterns = pvals
-        nlp.rsid_patterns = rsids
-        nlp.gc_relations = gc_relations
-
-        study = Experimental.load_bioc_study("BioC_Studies", F"{pmc_id}_bioc.json")
-        if not study:
-            continue
-        if not study["documents"][0]["id"]:
-            study["documents"][0]["id"] = pmc_id
-        fulltext = "\n".join([x['text'] for x in study['documents'][0]['passages']])
-        altered_text = re.sub(r"(?:\w)(\()", lambda x: x.group().replace("(", " ("), fulltext)
-
-        abbreviations = nlp.get_all_abbreviations(altered_text)
-        file_abbrevs = nlp.get_study_abbreviations(F"BioC_Studies/{pmc_id}_abbreviations.json")
-        if file_abbrevs:
-            abbreviations += file_abbrevs
-        abbreviations = [[re.escape(x), y] for x, y in abbreviations]
-        nlp.set_abbreviations(abbreviations)  # TODO: Check abbreviation partial entity HPC.
-
-        result, nlp = process_study(nlp, study)
-        nlp.clear_saved_study_data()
-
-        study_tables, contains_annotations = GCTableExtractor.parse_tables(F"BioC_Studies/{pmc_id}_tables.json", nlp)
-
-        time_taken = (datetime.now() - start_time).total_seconds()
-        study_processing_times.append((pmc_id, time_taken))
-        if contains_annotations:
-            TableExtractor.output_tables(F"output/{pmc_id}_tables.json", study_tables)
-        if not result['documents'][0]['relations'] and not contains_annotations:
-            failed_documents.append(pmc_id)
+                if len(gc_data[pmc_id]) > 10:
+                    break
+            if gwas_catalog_data:
+                for catalog_relation in gwas_catalog_data:
+                    rsid = catalog_relation[0]
+                    new_pvals = generate_pval_regex_strings(catalog_relation[1])
+                    pvals.extend(new_pvals)
+                    rsids.append(F"({rsid})")
+                    for x in new_pvals:
+                        gc_relations.append([x, rsid, mesh_id])
+            nlp.set_ontology_terms([x for x in mesh_terms if x])
+            nlp.pval_patterns = pvals
+            nlp.rsid_patterns = rsids
+            nlp.gc_relations = gc_relations
+
+            study = Experimental.load_bioc_study("BioC_Studies", F"{pmc_id}_bioc.json")
+            if not study:
+                output_writer.submit(save_checkpoint, checkpoint, pmc_id, "skipped")
+                continue
+            if not study["documents"][0]["id"]:
+                study["documents"][0]["id"] = pmc_id
+            fulltext = "\n".join([x['text'] for x in study['documents'][0]['passages']])
+            altered_text = re.sub(r"(?:\w)(\()", lambda x: x.group().replace("(", " ("), fulltext)
+
+            abbreviations = nlp.get_all_abbreviations(altered_text)
+            file_abbrevs = nlp.get_study_abbreviations(F"BioC_Studies/{pmc_id}_abbreviations.json")
+            if file_abbrevs:
+                abbreviations += file_abbrevs
+            abbreviations = [[re.escape(x), y] for x, y in abbreviations]
+            nlp.set_abbreviations(abbreviations)  # TODO: Check abbreviation partial entity HPC.
+
+            result, nlp = process_study(nlp, study, write_output=False)
+            nlp.clear_saved_study_data()
+
+            tables_file = F"BioC_Studies/{pmc_id}_tables.json"
+            if os.path.isfile(tables_file) and os.path.getsize(tables_file) >= TableExtractor.stream_min_file_size:
+                # Large files are written as they are annotated, rather than being held in memory.
+                study_tables = None
+                table_count, contains_annotations = GCTableExtractor.stream_tables(tables_file,
+                                                                                   F"output/{pmc_id}_tables.json", nlp)
+            else:
+                study_tables, contains_annotations = GCTableExtractor.parse_tables(tables_file, nlp)
+
+            time_taken = (datetime.now() - start_time).total_seconds()
+            study_processing_times.append((pmc_id, time_taken))
+            if not result['documents'][0]['relations'] and not contains_annotations:
+                failed_documents.append(pmc_id)
+                status = "failed"
+            else:
+                status = "complete"
+            output_writer.submit(write_study_outputs, checkpoint, pmc_id, status, time_taken, result,
+                                 study_tables if contains_annotations else None)
+    finally:
+        # Finish writing the studies already processed, even if processing stopped with an error.
+        output_writer.close()
+        checkpoint.close()
 
     def avg(times):
         sum = 0
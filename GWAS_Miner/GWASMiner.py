@@ -16,7 +16,8 @@ import BioC
 import json
 # import OutputConverter
 from GWAS_Miner import OutputConverter
-from TableExtractor import parse_tables, output_tables
+import OutputWriter
+from TableExtractor import parse_tables, output_tables, stream_tables, stream_min_file_size
 
 
 def __load_config():
@@ -37,6 +38,8 @@ def __load_config():
 
 def __prepare_ontology_data():
     import Ontology
+    if config.get(section="ontology", option="lexicon_format", fallback="pickle").lower() == "sqlite":
+        return Ontology.get_master_lexicon_store()
     return Ontology.get_master_lexicon()
 
 
@@ -46,8 +49,11 @@ lexicon = None
 nlp = None
 gui = None
 is_cancelled = False
-global output_xml
+output_xml = False
 processed_files = []
+result_cache_enabled = False
+manifest = None
+output_writer = None
 
 
 def theme():
@@ -68,6 +74,9 @@ def load_nlp_object(qt_progress_signal=None, qt_finished_signal=None):
     if not nlp:
         update_gui_progress(qt_progress_signal, "Loading NLP Pipeline...")
         nlp = Interpreter(lexicon)
+        if result_cache_enabled:
+            import ResultCache
+            nlp.result_cache = ResultCache.PassageCache()
         if qt_finished_signal:
             qt_finished_signal.emit(True)
             return
@@ -80,25 +89,32 @@ def update_gui_progress(qt_progress_signal, text):
     qt_progress_signal.emit(text)
 
 
-def output_study_results(study, qt_study_finished_signal=None):
+def output_study_results(study, qt_study_finished_signal=None, study_manifest=None, file_path=None):
     # if qt_study_finished_signal:
     #     from GUI import QtFinishedResponse
     #     response = QtFinishedResponse(False, F"PMC{study['documents'][0]['id']}")
     #     qt_study_finished_signal.emit(response)
     #     return
+    __write_output(__write_study_results, study, qt_study_finished_signal, study_manifest, file_path)
+
+
+def __write_study_results(study, qt_study_finished_signal=None, study_manifest=None, file_path=None):
     global output_xml
-    # if output_xml:
-    # Convert study to json, then convert to BioC XML document for output.
-    # xml_study = json.dumps(study, default=BioC.ComplexHandler)
-    # xml_study = bioc.loads(xml_study, BioCFileType.BIOC_JSON)
-    # with open(F"output/PMC{study['documents'][0]['id']}_result.xml", "w", encoding="utf-8") as out_file:
-    #     bioc.dump(xml_study, out_file)
-    # # else:
-    # with open(F"output/PMC{study['documents'][0]['id']}_result.json", "w", encoding="utf-8") as out_file:
-    #     json.dump(study, out_file, default=BioC.ComplexHandler)
-    OutputConverter.output_xml(json.dumps(study, default=BioC.ComplexHandler),
-                               F"output/xml/{study['documents'][0]['id']}_result.xml")
-    OutputConverter.output_json(study, F"output/json/{study['documents'][0]['id']}_result.json")
+    # Write the study in either BioC XML or BioC JSON format, as selected by the xml argument.
+    try:
+        if output_xml:
+            OutputConverter.output_study(study, xml_file=get_study_output_paths(study)[0])
+        else:
+            OutputConverter.output_study(study, json_file=get_study_output_paths(study)[0])
+    except Exception as e:
+        logger.error(F"Unable to write the output for {study['documents'][0]['id']}: {e}")
+        # The outcome is recorded in the same task as the write, so a study is never recorded as complete without
+        # its output.
+        if study_manifest:
+            study_manifest.record(file_path, "failed")
+        return
+    if study_manifest:
+        study_manifest.record(file_path, "complete", get_study_output_paths(study))
 
     if qt_study_finished_signal:
         from GUI import QtFinishedResponse
@@ -106,6 +122,36 @@ def output_study_results(study, qt_study_finished_signal=None):
         qt_study_finished_signal.emit(response)
 
 
+def __write_table_results(file_path, destination, tables, study_manifest=None):
+    written = output_tables(destination, tables)
+    # The outcome is recorded in the same task as the write, so a file is never recorded as complete without its
+    # output.
+    if study_manifest:
+        study_manifest.record(file_path, "complete" if written else "failed", [destination] if written else None)
+
+
+def __write_output(function, *args, **kwargs):
+    """
+    Write output using the background writer when one is running, otherwise write it immediately.
+    @param function: Function performing the write.
+    """
+    if output_writer:
+        output_writer.submit(function, *args, **kwargs)
+    else:
+        function(*args, **kwargs)
+
+
+def get_study_output_paths(study):
+    """
+    Get the output file paths written for a study, in the format selected by the xml argument.
+    @param study: BioC study dictionary.
+    @return: List containing the XML or JSON output file path.
+    """
+    if output_xml:
+        return [F"output/xml/{study['documents'][0]['id']}_result.xml"]
+    return [F"output/json/{study['documents'][0]['id']}_result.json"]
+
+
 def get_study_visualisations(study, qt_progress_signal=None, qt_finished_signal=None):
     nlp_object = load_nlp_object(qt_progress_signal)
     if study is None:
@@ -127,7 +173,8 @@ def get_study_visualisations(study, qt_progress_signal=None, qt_finished_signal=
         qt_finished_signal.emit(response)
 
 
-def process_study(nlp, study, qt_progress_signal=None, qt_study_finished_signal=None):
+def process_study(nlp, study, qt_progress_signal=None, qt_study_finished_signal=None, study_manifest=None,
+                  file_path=None):
     global is_cancelled
     if not study or is_cancelled:
         return False
@@ -135,15 +182,12 @@ def process_study(nlp, study, qt_progress_signal=None, qt_study_finished_signal=
     update_gui_progress(qt_progress_signal, F"Identifying data from study {study['documents'][0]['id']}...")
     t, m, p = 0, 0, 0
     # abbreviations = nlp.get_all_abbreviations(study_fulltext)
-    for passage in study['documents'][0]['passages']:
-        if "section_title_1" in passage["infons"].keys() and passage["infons"]["section_title_1"].lower() != "results":
-            continue
-        passage_text = passage['text']
-        # if abbreviations:
-        #     for abbrev in abbreviations:
-        #         passage_text = passage_text.replace(abbrev[0], abbrev[1])
-
-        doc = nlp.process_corpus(passage_text)
+    passages = [x for x in study['documents'][0]['passages'] if "section_title_1" not in x["infons"].keys() or
+                x["infons"]["section_title_1"].lower() == "results"]
+    # if abbreviations:
+    #     for abbrev in abbreviations:
+    #         passage_text = passage_text.replace(abbrev[0], abbrev[1])
+    for passage, doc in zip(passages, nlp.process_corpora([x['text'] for x in passages])):
         # for sent in doc.sents:
         #     training_sent = [x.label_ for x in sent.ents]
         #     if training_sent:
@@ -195,7 +239,7 @@ def process_study(nlp, study, qt_progress_signal=None, qt_study_finished_signal=
         if relations:
             print(relations)
 
-    output_study_results(study, qt_study_finished_signal)
+    output_study_results(study, qt_study_finished_signal, study_manifest, file_path)
     return True
 
 
@@ -234,42 +278,143 @@ def process_studies(directory, visualise=None, shortlist=None, qt_progress_signa
         return
 
     # Process each publication file in turn
-    for file_name in os.listdir(directory):
-        if shortlist:
-            if file_name not in shortlist:
-                continue
-        if is_cancelled:
-            qt_study_finished_signal.emit(cancel_response)
-            return
+    file_names = [x for x in os.listdir(directory) if not shortlist or x in shortlist]
+    if manifest:
+        file_names = manifest.get_pending_files(directory, file_names)
+    # Results are written on a background thread while the next file is processed.
+    global output_writer
+    output_writer = OutputWriter.BackgroundWriter()
+    try:
+        for file_name in file_names:
+            if is_cancelled:
+                # Finish writing the files already processed before reporting the cancellation.
+                output_writer.close()
+                qt_study_finished_signal.emit(cancel_response)
+                return
+            process_file(nlp_object, directory, file_name, qt_progress_signal, qt_study_finished_signal, manifest)
+    finally:
+        output_writer.close()
+        output_writer = None
 
-        logger.info(F"Extracting data for file: {file_name}")
-        update_gui_progress(qt_progress_signal, F"Extracting data for file: {file_name}")
-
-        if file_name.endswith("tables.json"):
-            tables, contains_annotations = parse_tables(os.path.join(directory, file_name), nlp_object)
-            if tables and contains_annotations:
-                output_tables(F"output/json/{file_name}", tables)
-            elif tables and not contains_annotations:
-                update_gui_progress(qt_progress_signal, F"No annotations found for {file_name}...")
-            else:
-                update_gui_progress(qt_progress_signal, F"Unable to process study {file_name}. Skipping...")
-            continue
-        study = prepare_study(directory, file_name)
-
-        if not study:
+    if qt_study_finished_signal:
+        response = QtFinishedResponse(True, "Finished processing.", 1)
+        qt_study_finished_signal.emit(response)
+
+
+def process_file(nlp_object, directory, file_name, qt_progress_signal=None, qt_study_finished_signal=None,
+                 study_manifest=None):
+    """
+    Extract data from a single publication or tables file within the provided directory.
+    @param nlp_object: Interpreter object used for NLP processing.
+    @param directory: Directory containing the file.
+    @param file_name: Name of the publication/tables file.
+    @param study_manifest: StudyManifest object to record the outcome in.
+    @return: True if the file was processed successfully, otherwise False.
+    """
+    import os
+    logger.info(F"Extracting data for file: {file_name}")
+    update_gui_progress(qt_progress_signal, F"Extracting data for file: {file_name}")
+    file_path = os.path.join(directory, file_name)
+
+    if file_name.endswith("tables.json"):
+        destination = F"output/json/{file_name}"
+        if os.path.getsize(file_path) >= stream_min_file_size:
+            # Large files are written as they are annotated, rather than being held in memory.
+            table_count, contains_annotations = stream_tables(file_path, destination, nlp_object)
+            tables = None
+            processed = table_count is not None
+        else:
+            tables, contains_annotations = parse_tables(file_path, nlp_object)
+            processed = bool(tables)
+        if not processed:
+            update_gui_progress(qt_progress_signal, F"Unable to process study {file_name}. Skipping...")
+            if study_manifest:
+                __write_output(study_manifest.record, file_path, "failed")
+            return False
+        if not contains_annotations:
+            update_gui_progress(qt_progress_signal, F"No annotations found for {file_name}...")
+        if tables and contains_annotations:
+            # The outcome is recorded by the same task writing the tables.
+            __write_output(__write_table_results, file_path, destination, tables, study_manifest)
+        elif study_manifest:
+            __write_output(study_manifest.record, file_path, "complete", [destination] if contains_annotations else [])
+        return True
+    study = prepare_study(directory, file_name)
+
+    if not study:
+        if qt_study_finished_signal:
+            from GUI import QtFinishedResponse
             response = QtFinishedResponse(False, file_name)
             qt_study_finished_signal.emit(response)
-            continue
+        if study_manifest:
+            __write_output(study_manifest.record, file_path, "failed")
+        return False
 
-        logger.info(F"Processing PMC {study['documents'][0]['id']}")
-        result = process_study(nlp_object, study, qt_progress_signal, qt_study_finished_signal)
+    logger.info(F"Processing PMC {study['documents'][0]['id']}")
+    # Successful studies are recorded in the manifest by the task writing their output.
+    result = process_study(nlp_object, study, qt_progress_signal, qt_study_finished_signal, study_manifest, file_path)
 
-        if not result:
-            update_gui_progress(qt_progress_signal, F"Unable to process study {file_name}. Skipping...")
+    if not result:
+        update_gui_progress(qt_progress_signal, F"Unable to process study {file_name}. Skipping...")
+        if study_manifest:
+            __write_output(study_manifest.record, file_path, "failed")
+    return result
 
-    if qt_study_finished_signal:
-        response = QtFinishedResponse(True, "Finished processing.", 1)
-        qt_study_finished_signal.emit(response)
+
+def __init_worker(use_result_cache=False, study_manifest=None, xml_output=False):
+    """
+    (Pool initialiser) Load the NLP pipeline once for each worker process.
+    @param use_result_cache: Reuse processed passages stored in the result cache.
+    @param study_manifest: StudyManifest object to record outcomes in.
+    @param xml_output: Write results in BioC XML format rather than JSON.
+    """
+    global result_cache_enabled, manifest, output_xml
+    result_cache_enabled = use_result_cache
+    manifest = study_manifest
+    output_xml = xml_output
+    load_nlp_object()
+
+
+def __process_file_worker(directory, file_name):
+    """
+    (Pool task) Process a single file using the NLP pipeline belonging to this worker process.
+    @return: Tuple of the file name and processing result.
+    """
+    try:
+        return file_name, process_file(nlp, directory, file_name, study_manifest=manifest)
+    except Exception as e:
+        logger.error(F"An unexpected error occurred processing {file_name}: {e}")
+        if manifest:
+            import os
+            manifest.record(os.path.join(directory, file_name), "failed")
+        return file_name, False
+
+
+def process_studies_parallel(directory, cores, shortlist=None):
+    """[Processes each file within the provided directory using a pool of worker processes.]
+
+    Each worker builds its own Interpreter once and then takes file names from the pool's task queue, writing the
+    results for each file itself.
+
+    Args: directory ([string]): [directory containing publication files.] cores ([int]): [number of worker
+    processes to start, 0 = max available.] shortlist ([list], optional): [file names to restrict processing to.]
+    """
+    import os
+    from functools import partial
+    from multiprocessing import Pool
+
+    if cores < 1:
+        cores = os.cpu_count()
+    file_names = [x for x in os.listdir(directory) if not shortlist or x in shortlist]
+    if manifest:
+        file_names = manifest.get_pending_files(directory, file_names)
+    failed_files = []
+    with Pool(processes=cores, initializer=__init_worker, initargs=(result_cache_enabled, manifest, output_xml)) as pool:
+        for file_name, result in pool.imap_unordered(partial(__process_file_worker, directory), file_names):
+            if not result:
+                failed_files.append(file_name)
+    logger.info(F"Finished processing {len(file_names)} files using {cores} processes, {len(failed_files)} failed.")
+    return failed_files
 
 
 def visualise_study(file, visualisation_type):
@@ -294,20 +439,29 @@ def main():
     parser.add_argument('-d', '--docs', type=str, help='Directory containing the study JSON files.')
     parser.add_argument('-u', '--update_ont', action='store_true', help='Update ontology cache files from the source '
                                                                         'ontology files.')
+    parser.add_argument('--mesh_xml', type=str, help='MeSH descriptor XML file used to update the ontology cache '
+                                                     'instead of the Neo4j server.')
+    parser.add_argument('--hpo_obo', type=str, help='HPO OBO file used to update the ontology cache instead of the '
+                                                    'Neo4j server.')
     parser.add_argument('-v', '--visualise', type=str, help='Start displacy visualisation server for entities or '
                                                             'dependencies by specifying ents or sents respectively.')
     parser.add_argument('-g', '--interface', action='store_true', help='Launch using the graphical user interface.')
     parser.add_argument('-x', '--xml', action='store_true', help='Output results in BioC XML format rather than JSON.')
+    parser.add_argument('--cache', action='store_true', help='Reuse passages processed by previous runs with the same '
+                                                             'model, lexicon and patterns.')
+    parser.add_argument('--incremental', action='store_true', help='Only process new or changed files and files '
+                                                                   'which failed in previous runs.')
 
     # Parse input arguments
     args = parser.parse_args()
-    # cores = args.cores  # not yet implemented
+    cores = args.cores
     docs = args.docs
     visualise = args.visualise
     using_gui = args.interface
     update_ont = args.update_ont
-    global output_xml
+    global output_xml, result_cache_enabled
     output_xml = args.xml
+    result_cache_enabled = args.cache
 
     # Setup folder for log files.
     if not os.path.isdir("logs"):
@@ -322,6 +476,12 @@ def main():
             os.makedirs("output")
         except IOError as e:
             sys.exit(F"Unable to create output folder: {e}")
+    for output_folder in ["output/json", "output/xml"]:
+        if not os.path.isdir(output_folder):
+            try:
+                os.makedirs(output_folder)
+            except IOError as e:
+                sys.exit(F"Unable to create output folder: {e}")
 
     # Configure logger
     import time
@@ -332,11 +492,16 @@ def main():
     # Update ontology cache files if requested.
     if update_ont:
         import Ontology
-        Ontology.update_ontology_cache()
+        Ontology.update_ontology_cache(mesh_file=args.mesh_xml, hpo_file=args.hpo_obo)
 
     if not using_gui:
         global lexicon
         lexicon = __prepare_ontology_data()
+        if args.incremental:
+            import Manifest
+            from NLP import Interpreter
+            global manifest
+            manifest = Manifest.StudyManifest(Interpreter.get_lexicon_version(lexicon), "xml" if output_xml else "json")
     # Begin running either the GUI or processing studies immediately.
     if using_gui:
         os.environ["QT_AUTO_SCREEN_SCALE_FACTOR"] = "1"
@@ -347,6 +512,8 @@ def main():
     else:
         if visualise and docs:
             visualise_study(docs, visualise)
+        elif docs and cores != 1:
+            process_studies_parallel(docs, cores)
         elif docs:
             process_studies(docs)
         else:
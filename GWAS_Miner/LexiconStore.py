@@ -0,0 +1,167 @@
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from functools import lru_cache
+
+from DataStructures import BaseLexicon, LexiconEntry, MasterLexicon
+
+logger = logging.getLogger("GWAS Miner")
+
+# Maximum number of bytes of the store file that SQLite may memory-map.
+mmap_size = 1 << 30
+entry_cache_size = 8192
+
+
+def write_lexicon_store(master_lexicon, file_path):
+    """
+    Write the master lexicon to an indexed SQLite store. The store is written to a temporary file in the same
+    directory first and then moved into place, so readers never observe a partially written file.
+    @param master_lexicon: MasterLexicon object to store.
+    @param file_path: Destination file path for the store.
+    """
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or ".", suffix=".tmp")
+    os.close(handle)
+    try:
+        connection = sqlite3.connect(temp_path)
+        with connection:
+            connection.executescript("""
+                CREATE TABLE lexicons (name TEXT PRIMARY KEY, position INTEGER);
+                CREATE TABLE entries (entry_id INTEGER PRIMARY KEY, lexicon TEXT, identifier TEXT, name TEXT,
+                                      name_lower TEXT, tree_ids TEXT);
+                CREATE TABLE synonyms (entry_id INTEGER, lexicon TEXT, syn_id TEXT, name TEXT, name_lower TEXT);
+            """)
+            entry_id = 0
+            for position, lexicon in enumerate(master_lexicon.get_ordered_lexicons()):
+                connection.execute("INSERT INTO lexicons VALUES (?, ?)", (lexicon.name, position))
+                for entry in lexicon.get_entries():
+                    connection.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                                       (entry_id, lexicon.name, entry.identifier, entry.name(),
+                                        entry.name().lower(), json.dumps(entry.tree_id())))
+                    connection.executemany("INSERT INTO synonyms VALUES (?, ?, ?, ?, ?)",
+                                           [(entry_id, lexicon.name, syn["id"], syn["name"], syn["name"].lower())
+                                            for syn in entry.synonyms()])
+                    entry_id += 1
+            connection.executescript("""
+                CREATE INDEX entries_identifier ON entries (lexicon, identifier);
+                CREATE INDEX entries_name ON entries (lexicon, name_lower);
+                CREATE INDEX synonyms_entry ON synonyms (entry_id);
+                CREATE INDEX synonyms_name ON synonyms (lexicon, name_lower);
+            """)
+        connection.close()
+        os.replace(temp_path, file_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def load_lexicon_store(file_path):
+    """
+    Open an indexed SQLite lexicon store. Entries are only read from the store when requested.
+    @param file_path: File path of the store.
+    @return: MasterLexicon object containing a StoredLexicon for each stored lexicon.
+    """
+    connection = sqlite3.connect(F"file:{file_path}?mode=ro", uri=True)
+    names = [x[0] for x in connection.execute("SELECT name FROM lexicons ORDER BY position")]
+    connection.close()
+    master = MasterLexicon()
+    for name in names:
+        master.add_lexicon(StoredLexicon(name, file_path))
+    return master
+
+
+class StoredLexicon(BaseLexicon):
+    """
+    Read-only lexicon backed by an indexed SQLite store. Each process opens its own memory-mapped connection, so
+    worker processes share the store pages through the OS page cache instead of each holding a copy of the lexicon.
+    Stored lexicons are updated by writing the store again with write_lexicon_store.
+    """
+
+    def __init__(self, name, file_path):
+        super().__init__(name)
+        self.file_path = file_path
+        self.__connection = None
+        self.__pid = None
+        self.__cached_entry = lru_cache(maxsize=entry_cache_size)(self.__load_entry)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_StoredLexicon__connection"] = None
+        state["_StoredLexicon__pid"] = None
+        del state["_StoredLexicon__cached_entry"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__cached_entry = lru_cache(maxsize=entry_cache_size)(self.__load_entry)
+
+    def __get_connection(self):
+        # Connections must not be shared with forked worker processes.
+        if self.__connection is None or self.__pid != os.getpid():
+            self.__connection = sqlite3.connect(F"file:{self.file_path}?mode=ro", uri=True, check_same_thread=False)
+            self.__connection.execute(F"PRAGMA mmap_size = {mmap_size}")
+            self.__pid = os.getpid()
+            self.__cached_entry.cache_clear()
+        return self.__connection
+
+    @staticmethod
+    def __create_entry(identifier, name, tree_ids, synonyms):
+        tree_ids = json.loads(tree_ids)
+        entry = LexiconEntry(identifier, name, tree_id=tree_ids[0] if tree_ids else None)
+        for tree_id in tree_ids[1:]:
+            entry.add_tree_id(tree_id)
+        for syn_id, syn_name in synonyms:
+            entry.add_synonym(syn_id, syn_name)
+        return entry
+
+    def __load_entry(self, entry_id):
+        connection = self.__get_connection()
+        row = connection.execute("SELECT identifier, name, tree_ids FROM entries WHERE entry_id = ?",
+                                 (entry_id,)).fetchone()
+        if not row:
+            return None
+        synonyms = connection.execute("SELECT syn_id, name FROM synonyms WHERE entry_id = ? ORDER BY rowid",
+                                      (entry_id,)).fetchall()
+        return StoredLexicon.__create_entry(row[0], row[1], row[2], synonyms)
+
+    def __get_entry(self, entry_id):
+        self.__get_connection()
+        return self.__cached_entry(entry_id) if entry_id is not None else None
+
+    def get_entries(self):
+        """
+        Iterate over every entry in the stored lexicon, in the order they were originally added.
+        @return: Generator of LexiconEntry objects.
+        """
+        rows = self.__get_connection().execute("""
+            SELECT e.entry_id, e.identifier, e.name, e.tree_ids, s.syn_id, s.name
+            FROM entries e LEFT JOIN synonyms s ON s.entry_id = e.entry_id
+            WHERE e.lexicon = ?
+            ORDER BY e.entry_id, s.rowid
+        """, (self.name,))
+        for entry_id, group in itertools.groupby(rows, key=lambda x: x[0]):
+            group = list(group)
+            synonyms = [(x[4], x[5]) for x in group if x[5] is not None]
+            yield StoredLexicon.__create_entry(group[0][1], group[0][2], group[0][3], synonyms)
+
+    def identifier_used(self, identifier):
+        return self.__get_connection().execute("SELECT 1 FROM entries WHERE lexicon = ? AND identifier = ? LIMIT 1",
+                                               (self.name, identifier)).fetchone() is not None
+
+    def get_entry_by_term(self, term):
+        term = term.lower()
+        row = self.__get_connection().execute("""
+            SELECT MIN(entry_id) FROM (
+                SELECT entry_id FROM entries WHERE lexicon = ? AND name_lower = ?
+                UNION ALL
+                SELECT entry_id FROM synonyms WHERE lexicon = ? AND name_lower = ?
+            )
+        """, (self.name, term, self.name, term)).fetchone()
+        return self.__get_entry(row[0])
+
+    def get_entry_by_id(self, ident):
+        row = self.__get_connection().execute("SELECT MIN(entry_id) FROM entries WHERE lexicon = ? AND identifier = ?",
+                                              (self.name, ident)).fetchone()
+        return self.__get_entry(row[0])
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+logger = logging.getLogger("GWAS Miner")
+
+manifest_file = "output/manifest.db"
+# Increment when extraction changes in a way that should cause every study to be processed again.
+tool_version = "0.0.1"
+
+
+class StudyManifest:
+    """
+    Persistent record of the studies processed into the output directory. Each input file is stored with its content
+    hash, the tool and lexicon versions used, the output format and files written and whether processing succeeded,
+    so incremental runs can skip studies that are unchanged since they were last processed successfully.
+    """
+
+    def __init__(self, lexicon_version, output_format="json", file_path=manifest_file):
+        self.lexicon_version = lexicon_version
+        self.output_format = output_format
+        self.file_path = file_path
+        self.__connection = None
+        self.__pid = None
+        self.__file_hashes = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_StudyManifest__connection"] = None
+        state["_StudyManifest__pid"] = None
+        return state
+
+    def __get_connection(self):
+        # Connections must not be shared with forked worker processes.
+        if self.__connection is None or self.__pid != os.getpid():
+            # Outcomes may be recorded from the background output writer thread.
+            self.__connection = sqlite3.connect(self.file_path, timeout=60, check_same_thread=False)
+            self.__connection.execute("PRAGMA journal_mode = WAL")
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS studies (file_name TEXT PRIMARY KEY, file_hash TEXT, tool_version TEXT,
+                                                    lexicon_version TEXT, outputs TEXT, status TEXT, updated_at TEXT,
+                                                    output_format TEXT)
+            """)
+            # Manifests written before the output format was recorded are migrated, their rows are never current.
+            columns = [x[1] for x in self.__connection.execute("PRAGMA table_info(studies)")]
+            if "output_format" not in columns:
+                self.__connection.execute("ALTER TABLE studies ADD COLUMN output_format TEXT")
+            self.__pid = os.getpid()
+        return self.__connection
+
+    def get_file_hash(self, file_path):
+        """
+        Calculate the content hash of an input file, reusing the previous result if the file is unmodified.
+        @param file_path: Path of the input file.
+        @return: Hex digest string.
+        """
+        stat = os.stat(file_path)
+        key = (file_path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.__file_hashes:
+            digest = hashlib.sha1()
+            with open(file_path, "rb") as f_in:
+                for block in iter(lambda: f_in.read(1 << 20), b""):
+                    digest.update(block)
+            self.__file_hashes[key] = digest.hexdigest()
+        return self.__file_hashes[key]
+
+    def is_current(self, file_path):
+        """
+        Check whether an input file was processed successfully by the current tool and lexicon versions, into the
+        current output format.
+        @param file_path: Path of the input file.
+        @return: True if the file is unchanged since it was last processed successfully and its outputs still exist.
+        """
+        row = self.__get_connection().execute(
+            "SELECT file_hash, tool_version, lexicon_version, outputs, status, output_format FROM studies "
+            "WHERE file_name = ?", (os.path.basename(file_path),)).fetchone()
+        if not row or row[4] != "complete" or row[1] != tool_version or row[2] != self.lexicon_version:
+            return False
+        if row[5] != self.output_format:
+            return False
+        if [x for x in json.loads(row[3]) if not os.path.isfile(x)]:
+            return False
+        return row[0] == self.get_file_hash(file_path)
+
+    def record(self, file_path, status, outputs=None):
+        """
+        Record the outcome of processing an input file.
+        @param file_path: Path of the input file.
+        @param status: complete or failed.
+        @param outputs: List of output file paths written for the input file.
+        """
+        try:
+            with self.__get_connection() as connection:
+                connection.execute("INSERT OR REPLACE INTO studies (file_name, file_hash, tool_version, "
+                                   "lexicon_version, outputs, status, updated_at, output_format) "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (os.path.basename(file_path), self.get_file_hash(file_path), tool_version,
+                                    self.lexicon_version, json.dumps(outputs or []), status,
+                                    datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"), self.output_format))
+        except (sqlite3.Error, IOError) as e:
+            logger.error(F"Unable to update the study manifest for {file_path}: {e}")
+
+    def get_pending_files(self, directory, file_names):
+        """
+        Filter out input files which do not need processing again.
+        @param directory: Directory containing the input files.
+        @param file_names: Names of the input files.
+        @return: List of the file names which are new, changed or previously failed.
+        """
+        pending = [x for x in file_names if not self.is_current(os.path.join(directory, x))]
+        logger.info(F"Skipping {len(file_names) - len(pending)} unchanged files, {len(pending)} to process.")
+        return pending
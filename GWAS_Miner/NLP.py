@@ -1,19 +1,30 @@
+import bisect
+import hashlib
 import itertools
 import json
 import logging
+import os
 import re
+import tempfile
+
+import srsly
 from spacy.pipeline import merge_entities
 
+import PatternRegistry
+import ResultCache
 import config
-import networkx as nx
 import spacy
+from DependencyPaths import DependencyTree
 from DataStructures import Marker, Phenotype, Significance, Association, LexiconEntry
 from spacy import displacy
 from spacy.matcher import Matcher, PhraseMatcher
-from spacy.tokens import Span, Token, Doc
+from spacy.tokens import Span, Token, Doc, DocBin
 
 from Utility_Functions import Utility
 
+phrase_pattern_cache = "../ontology_data/phrase_patterns.cache"
+phrase_pattern_cache_version = 1
+
 
 class Interpreter:
     def __init__(self, lexicon, ontology_only=False):
@@ -50,6 +61,9 @@ class Interpreter:
         self.annotations = []
         self.relations = []
         self.association_patterns = config.pheno_assoc_patterns
+        self.lexicon_version = None
+        self.result_cache = None
+        self.__model_fingerprint = None
         if not ontology_only:
             self.__add_matchers(lexicon)
 
@@ -86,15 +100,11 @@ class Interpreter:
         self.__basic_matcher.add('marker', [[self.__marker_regex]], on_match=self.__on_match)
         self.__basic_matcher.add('RSID', [[self.__rsid_regex]], on_match=self.__on_match)
 
-        new_matcher = PhraseMatcher(self.model.vocab, attr="LOWER")
-        for lexicon in lexicon.get_ordered_lexicons():
-            if lexicon.name == "HPO":
-                continue
-            for entry in lexicon.get_entries():
-                patterns = Interpreter.get_term_variations(entry)
-                patterns = self.model.tokenizer.pipe(patterns)
-                new_matcher.add(entry.identifier, patterns, on_match=self.__on_match)
-        self.__phrase_matcher = new_matcher
+        self.lexicon_version = Interpreter.get_lexicon_version(lexicon)
+        fingerprint = self.__get_matcher_fingerprint()
+        self.__phrase_matcher = self.__load_phrase_matcher(fingerprint)
+        if not self.__phrase_matcher:
+            self.__phrase_matcher = self.__build_phrase_matcher(lexicon, fingerprint)
         # Assign extension getters
         Token.set_extension("matches_ontology", getter=self.ontology_getter)
         Token.set_extension("is_trait", getter=self.is_trait_getter)
@@ -106,6 +116,119 @@ class Interpreter:
         Doc.set_extension("has_trait", getter=self.has_trait_getter)
         Doc.set_extension("is_trait", getter=self.is_trait_getter)
 
+    @staticmethod
+    def get_lexicon_version(master_lexicon):
+        """
+        Calculate a hash of every entry, name and synonym within the master lexicon.
+        @param master_lexicon: MasterLexicon object to identify.
+        @return: Hex digest string identifying the lexicon contents.
+        """
+        digest = hashlib.sha1()
+        for lexicon in master_lexicon.get_ordered_lexicons():
+            digest.update(F"<{lexicon.name}>".encode("utf-8"))
+            for entry in lexicon.get_entries():
+                digest.update(F"{entry.identifier}\t{entry.name()}".encode("utf-8"))
+                for syn in entry.synonyms():
+                    digest.update(F"\t{syn['name']}".encode("utf-8"))
+                digest.update(b"\n")
+        return digest.hexdigest()
+
+    def __get_matcher_fingerprint(self):
+        """
+        Calculate a hash identifying the phrase matcher patterns for the current lexicon and tokenizer settings.
+        @return: Hex digest string.
+        """
+        digest = hashlib.sha1()
+        digest.update(F"{phrase_pattern_cache_version}:{spacy.__version__}:{self.lexicon_version}".encode("utf-8"))
+        digest.update(F"{self.model.meta.get('name')}:{self.model.meta.get('version')}".encode("utf-8"))
+        digest.update(self.model.tokenizer.to_bytes(exclude=["vocab"]))
+        return digest.hexdigest()
+
+    def get_model_fingerprint(self):
+        """
+        Calculate a hash identifying the model and tokenizer settings used to parse documents.
+        @return: Hex digest string.
+        """
+        if not self.__model_fingerprint:
+            digest = hashlib.sha1()
+            digest.update(F"{spacy.__version__}:{self.model.meta.get('name')}:{self.model.meta.get('version')}:"
+                          F"{','.join(self.model.pipe_names)}".encode("utf-8"))
+            digest.update(self.model.tokenizer.to_bytes(exclude=["vocab"]))
+            self.__model_fingerprint = digest.hexdigest()
+        return self.__model_fingerprint
+
+    def _get_annotation_settings(self, ontology_only=False):
+        """
+        List the settings affecting the entities added to a parsed document.
+        @param ontology_only: Only ontology term matching is applied.
+        @return: JSON serializable list of settings.
+        """
+        return [self.lexicon_version, ontology_only, config.regex_entity_patterns, self.__rsid_regex,
+                self.__marker_regex]
+
+    def get_annotation_fingerprint(self, ontology_only=False):
+        """
+        Calculate a hash identifying the model, lexicon and pattern settings used to annotate documents.
+        @param ontology_only: Only ontology term matching is applied.
+        @return: Hex digest string.
+        """
+        settings = json.dumps(self._get_annotation_settings(ontology_only), sort_keys=True)
+        return hashlib.sha1(F"{self.get_model_fingerprint()}:{settings}".encode("utf-8")).hexdigest()
+
+    def __load_phrase_matcher(self, fingerprint):
+        """
+        Load the phrase matcher patterns from the cache file if they were built for the current lexicon and tokenizer.
+        @param fingerprint: Hash of the current lexicon and tokenizer settings.
+        @return: PhraseMatcher object or None if the cache is missing or out of date.
+        """
+        try:
+            with open(phrase_pattern_cache, "rb") as file:
+                cache = srsly.msgpack_loads(file.read())
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            self.__logger.error(F"Unable to read phrase pattern cache: {ex}")
+            return None
+        if cache.get("fingerprint") != fingerprint:
+            self.__logger.info("Phrase pattern cache is out of date, rebuilding...")
+            return None
+        new_matcher = PhraseMatcher(self.model.vocab, attr="LOWER")
+        docs = DocBin().from_bytes(cache["docs"]).get_docs(self.model.vocab)
+        for identifier, pattern_count in cache["keys"]:
+            new_matcher.add(identifier, list(itertools.islice(docs, pattern_count)), on_match=self.__on_match)
+        return new_matcher
+
+    def __build_phrase_matcher(self, lexicon, fingerprint):
+        """
+        Build the phrase matcher patterns from every lexicon entry, saving the tokenized patterns to the cache file.
+        @param lexicon: MasterLexicon object containing the ontology terms.
+        @param fingerprint: Hash of the current lexicon and tokenizer settings.
+        @return: PhraseMatcher object.
+        """
+        new_matcher = PhraseMatcher(self.model.vocab, attr="LOWER")
+        doc_bin = DocBin(attrs=["ORTH"], store_user_data=False)
+        keys = []
+        for lexicon in lexicon.get_ordered_lexicons():
+            if lexicon.name == "HPO":
+                continue
+            for entry in lexicon.get_entries():
+                patterns = Interpreter.get_term_variations(entry)
+                patterns = list(self.model.tokenizer.pipe(patterns))
+                for pattern in patterns:
+                    doc_bin.add(pattern)
+                keys.append([entry.identifier, len(patterns)])
+                new_matcher.add(entry.identifier, patterns, on_match=self.__on_match)
+        cache = {"fingerprint": fingerprint, "keys": keys, "docs": doc_bin.to_bytes()}
+        try:
+            # Write to a temporary file first so that a partially written cache is never loaded.
+            cache_dir = os.path.dirname(phrase_pattern_cache)
+            with tempfile.NamedTemporaryFile("wb", dir=cache_dir, delete=False) as file:
+                file.write(srsly.msgpack_dumps(cache))
+            os.replace(file.name, phrase_pattern_cache)
+        except IOError as io:
+            self.__logger.error(F"Unable to create phrase pattern cache: {io}")
+        return new_matcher
+
     @staticmethod
     def get_term_variations(term: LexiconEntry):
         """
@@ -313,51 +436,93 @@ class Interpreter:
 
     def __on_match(self, matcher, doc, i, matches):
         """
-        (Event handler) Add matched entity to document entity list if no overlap is caused.
+        (Event handler) Buffer a matched entity for overlap resolution once all matchers have run.
         @param matcher: Matcher object which fired the event
         @param doc: nlp doc object
         @param i: index of the current match
         @param matches: list of matches found by the matcher object
         """
         match_id, start, end = matches[i]
-        entity = Span(doc, start, end,
-                      label=self.model.vocab.strings[match_id])
-        try:
-            doc.ents += (entity,)
-        except Exception:
-            entities_to_replace = []
-            for ent in doc.ents:
-                if (start <= ent.start < end) or (start < ent.end <= end):
+        doc.user_data.setdefault("match_candidates", []).append((match_id, start, end))
+
+    def __resolve_matches(self, doc):
+        """
+        Add the buffered matcher entities to the document entity list, in the order they were matched, and assign
+        the result to doc.ents once. A match overlapping existing entities is dropped unless it replaces them:
+        non-numeric labels override numeric labels and otherwise longer spans override shorter ones.
+        @param doc: nlp doc object containing buffered matches.
+        """
+        candidates = doc.user_data.pop("match_candidates", None)
+        if not candidates:
+            return
+        entities = list(doc.ents)
+        occupancy = [-1] * len(doc)  # Index into entities of the entity covering each token.
+        for index, ent in enumerate(entities):
+            for token in range(ent.start, ent.end):
+                occupancy[token] = index
+        for match_id, start, end in candidates:
+            overlapping = sorted({occupancy[x] for x in range(start, end) if occupancy[x] != -1},
+                                 key=lambda x: (entities[x].start, entities[x].end))
+            entity = Span(doc, start, end, label=self.model.vocab.strings[match_id])
+            if overlapping:
+                entities_to_replace = []
+                discard = False
+                for index in overlapping:
+                    ent = entities[index]
+                    if not ((start <= ent.start < end) or (start < ent.end <= end)):
+                        continue
                     if entity.label_.isnumeric() and not ent.label_.isnumeric():
-                        return
+                        discard = True
+                        break
                     if not entity.label_.isnumeric() and ent.label_.isnumeric():
-                        entities_to_replace.append(ent)
+                        entities_to_replace.append(index)
                         continue
                     if len(ent) < len(entity):
-                        entities_to_replace.append(ent)
-            if entities_to_replace:
-                doc.ents = [x for x in doc.ents if x not in entities_to_replace]
-                doc.ents += (entity,)
-            return
+                        entities_to_replace.append(index)
+                # The match is only added once every entity it overlaps has been replaced.
+                if discard or len(entities_to_replace) != len(overlapping):
+                    continue
+                for index in entities_to_replace:
+                    for token in range(entities[index].start, entities[index].end):
+                        occupancy[token] = -1
+                    entities[index] = None
+            entities.append(entity)
+            for token in range(start, end):
+                occupancy[token] = len(entities) - 1
+        doc.ents = sorted([x for x in entities if x is not None], key=lambda x: x.start)
+
+    @staticmethod
+    def get_token_at_char(doc, char_index):
+        """
+        Find the token containing a character of the document text. Token start offsets are computed once per doc
+        and cached in the doc user data, so repeated lookups are binary searches.
+        @param doc: SpaCy doc object.
+        @param char_index: Character offset within the document text.
+        @return: Index of the token containing the character, or None if the character is whitespace or out of range.
+        """
+        token_starts = doc.user_data.get("token_starts")
+        # Retokenizing changes the token count, which invalidates the cached offsets.
+        if token_starts is None or token_starts[0] != len(doc):
+            token_starts = (len(doc), [token.idx for token in doc])
+            doc.user_data["token_starts"] = token_starts
+        i = bisect.bisect_right(token_starts[1], char_index) - 1
+        if i < 0 or char_index >= token_starts[1][i] + len(doc[i].text):
+            return None
+        return i
 
     @staticmethod
     def _regex_match(pattern, doc, label, ignore_case=True):
-        chars_to_tokens = {}
-        for token in doc:
-            for i in range(token.idx, token.idx + len(token.text)):
-                chars_to_tokens[i] = token.i
-        if ignore_case:
-            try:
-                matches = re.finditer(pattern, doc.text_with_ws, flags=re.IGNORECASE)
-            except re.error as r:
-                matches = re.finditer(re.escape(pattern), doc.text_with_ws, flags=re.IGNORECASE)
-        else:
-            try:
-                matches = re.finditer(pattern, doc.text_with_ws)
-            except re.error as r:
-                matches = re.finditer(re.escape(pattern), doc.text_with_ws)
-        for match in matches:
-            start, end = match.span(1) if len(match.groups()) > 1 else match.span()
+        """
+        Add the entities matched by one or more regex patterns to the document.
+        @param pattern: Regex pattern string, or list of pattern strings in priority order, for the entity label.
+        @param doc: SpaCy doc object.
+        @param label: Entity label assigned to matches.
+        @param ignore_case: Match the patterns case insensitively.
+        """
+        stopped_patterns = set()
+        for pattern_index, start, end in PatternRegistry.find_spans(pattern, doc.text_with_ws, ignore_case):
+            if pattern_index in stopped_patterns:
+                continue
             span = doc.char_span(start, end, label=label, alignment_mode="expand")
             if span is not None:
                 try:
@@ -365,14 +530,14 @@ class Interpreter:
                 except:
                     continue
             else:
-                start_token = chars_to_tokens.get(start)
-                end_token = chars_to_tokens.get(end)
+                start_token = Interpreter.get_token_at_char(doc, start)
+                end_token = Interpreter.get_token_at_char(doc, end)
                 if start_token is not None and end_token is not None:
                     span = doc[start_token:end_token + 1]
                     try:
                         doc.ents += (span,)
                     except Exception:
-                        return  # print(e)
+                        stopped_patterns.add(pattern_index)  # print(e)
 
     def process_corpus(self, corpus, ontology_only=False):
         """[Applies tokenization, entity recognition and dependency parsing to the supplied corpus.]
@@ -384,25 +549,106 @@ class Interpreter:
         Returns:
             [SpaCy doc object]: [Parsed SpaCy doc object containing the processed input text with entities, tokens and dependencies.]
         """
-        doc = self.model(corpus)
+        if self.result_cache:
+            return next(self.__process_cached_corpora([corpus], 1, 1, ontology_only))
+        return self._annotate_doc(self.model(corpus), ontology_only)
 
+    def process_corpora(self, corpora, batch_size=64, n_process=1, ontology_only=False):
+        """[Applies tokenization, entity recognition and dependency parsing to each of the supplied texts in batches.]
+
+        Args:
+            corpora ([list]): [corpus strings for information extraction]
+            batch_size (int, optional): [Number of texts passed through the model at once]. Defaults to 64.
+            n_process (int, optional): [Number of processes used by the model]. Defaults to 1.
+            ontology_only (bool, optional): [Only apply ontology term matching to the supplied texts]. Defaults to False.
+
+        Returns:
+            [generator]: [Parsed SpaCy doc objects in the same order as the input texts.]
+        """
+        if self.result_cache:
+            yield from self.__process_cached_corpora(corpora, batch_size, n_process, ontology_only)
+            return
+        for doc in self.model.pipe(corpora, batch_size=batch_size, n_process=n_process):
+            yield self._annotate_doc(doc, ontology_only)
+
+    def annotate_tokens(self, corpora, ontology_only=False):
+        """[Applies tokenization and entity recognition to each of the supplied texts without running the model.]
+
+        The regex, rule and ontology matching only use token text, so the entities found are the same as
+        process_corpora, but the docs have no tags, dependencies or sentence boundaries.
+
+        Args:
+            corpora ([list]): [short structured strings, such as numeric table cells]
+            ontology_only (bool, optional): [Only apply ontology term matching to the supplied texts]. Defaults to False.
+
+        Returns:
+            [generator]: [SpaCy doc objects in the same order as the input texts.]
+        """
+        for text in corpora:
+            yield self._annotate_doc(self.model.make_doc(text), ontology_only)
+
+    def __process_cached_corpora(self, corpora, batch_size, n_process, ontology_only):
+        """
+        Process the supplied texts, reusing annotated documents or model parses stored in the result cache and
+        only passing texts without a stored parse through the model.
+        @return: Generator of annotated SpaCy doc objects in the same order as the input texts.
+        """
+        corpora = list(corpora)
+        parse_fingerprint = self.get_model_fingerprint()
+        annotation_fingerprint = self.get_annotation_fingerprint(ontology_only)
+        cached_docs = {}
+        unparsed = []
+        for i in range(len(corpora)):
+            data = self.result_cache.get_annotation(ResultCache.get_passage_key(corpora[i], annotation_fingerprint))
+            if data:
+                cached_docs[i] = (True, data)
+                continue
+            data = self.result_cache.get_parse(ResultCache.get_passage_key(corpora[i], parse_fingerprint))
+            if data:
+                cached_docs[i] = (False, data)
+            else:
+                unparsed.append(i)
+        parsed_docs = self.model.pipe([corpora[i] for i in unparsed], batch_size=batch_size, n_process=n_process)
+        for i in range(len(corpora)):
+            parse_data = None
+            if i in cached_docs:
+                annotated, data = cached_docs.pop(i)
+                doc = Doc(self.model.vocab).from_bytes(data)
+                if annotated:
+                    yield doc
+                    continue
+            else:
+                doc = next(parsed_docs)
+                parse_data = doc.to_bytes(exclude=["tensor", "user_data"])
+            doc = self._annotate_doc(doc, ontology_only)
+            # Each passage is stored and committed on its own, so the write lock shared with other worker processes
+            # is only held briefly.
+            if parse_data:
+                self.result_cache.set_parse(ResultCache.get_passage_key(corpora[i], parse_fingerprint), parse_data)
+            self.result_cache.set_annotation(ResultCache.get_passage_key(corpora[i], annotation_fingerprint),
+                                             doc.to_bytes(exclude=["tensor"]))
+            self.result_cache.commit()
+            yield doc
+
+    def _annotate_doc(self, doc, ontology_only=False):
+        """
+        Apply the regex, rule and ontology matching to a document parsed by the model.
+        @param doc: SpaCy doc object produced by the model.
+        @param ontology_only: Only apply ontology term matching to the document.
+        @return: SpaCy doc object with merged entities.
+        """
         old_ents, doc.ents = doc.ents, []
 
         #  Additional regex matches unnecessary when limited to ontology entities.
         if not ontology_only:
             for ent_label in config.regex_entity_patterns:
-                if isinstance(config.regex_entity_patterns[ent_label], list):
-                    for pattern in config.regex_entity_patterns[ent_label]:
-                        self._regex_match(pattern, doc, ent_label)
-                        if ent_label not in self.__entity_labels:
-                            self.__entity_labels.append(ent_label)
-                else:
-                    self._regex_match(config.regex_entity_patterns[ent_label], doc, ent_label)
-                    if ent_label not in self.__entity_labels:
-                        self.__entity_labels.append(ent_label)
+                self._regex_match(config.regex_entity_patterns[ent_label], doc, ent_label)
+                if ent_label not in self.__entity_labels:
+                    self.__entity_labels.append(ent_label)
         if len(self.__basic_matcher) > 0:
             self.__basic_matcher(doc)
         self.__phrase_matcher(doc)
+        self.__resolve_matches(doc)
 
         # Ensure that rule-matched entities override data model entities when needed.
         if not ontology_only:
@@ -476,20 +722,14 @@ class Interpreter:
     @staticmethod
     def _validate_node_entities(ents, nodes):
         output = []
-        used_indexes = []
         for item in ents:
             token_count = len([x for x in item if type(x) == Token])
             if token_count > 1:
-                split_item = [x.text + F"<id{x.idx}>" for x in item]
-                for node in nodes:
-                    for token in split_item:
-                        if token == str(node):
-                            output.append((item, F"{item}<id{item.start_char}>"))
-                            break
-            else:
-                for node in nodes:
-                    if F"{item.text}<id{item.start_char}>" == str(node):
-                        output.append((item, F"{item}<id{item.start_char}>"))
+                # One entry for each token of the entity found in the tree.
+                split_item = {x.text + F"<id{x.idx}>" for x in item}
+                output += [(item, F"{item}<id{item.start_char}>") for x in split_item if x in nodes]
+            elif F"{item.text}<id{item.start_char}>" in nodes:
+                output.append((item, F"{item}<id{item.start_char}>"))
         return output
 
     @staticmethod
@@ -616,30 +856,17 @@ class Interpreter:
         results = []
         # Iterate through each sentence containing a phenotype named entity label
         for sent in phenotype_sents:
-            edges = []
-            token_indexes = {}
-            for token in sent:
-                for child in token.children:
-                    # Add unique id to token strings.
-                    token_text = F"{token}<id{token.idx}>"
-                    child_text = F"{child}<id{child.idx}>"
-                    if token.idx not in token_indexes.keys():
-                        token_indexes[token.idx] = token.i
-                    if child.idx not in token_indexes.keys():
-                        token_indexes[child.idx] = child.i
-                    edges.append(('{0}'.format(token_text),
-                                  '{0}'.format(child_text)))
-
-            graph = nx.Graph(edges)
+            tree = DependencyTree(sent)
+            token_indexes = tree.token_indexes
 
             phenotypes = Interpreter._validate_node_entities(
-                [x for x in sent.ents if x._.has_trait], graph.nodes) if not top_phenotype else None
+                [x for x in sent.ents if x._.has_trait], tree.nodes) if not top_phenotype else None
             markers = Interpreter._validate_node_entities(
-                [x for x in sent.ents if x.label_ == 'RSID'], graph.nodes)
+                [x for x in sent.ents if x.label_ == 'RSID'], tree.nodes)
             genes = Interpreter._validate_node_entities(
-                [x for x in sent.ents if x.label_ == 'GENE'], graph.nodes)
+                [x for x in sent.ents if x.label_ == 'GENE'], tree.nodes)
             pvals = Interpreter._validate_node_entities(
-                [x for x in sent.ents if x.label_ == 'PVAL'], graph.nodes)
+                [x for x in sent.ents if x.label_ == 'PVAL'], tree.nodes)
 
             phenotype_count = len(phenotypes) if not top_phenotype else None
             marker_count = len(markers)
@@ -651,14 +878,14 @@ class Interpreter:
             for marker in markers:
                 best_pval_distance = None
                 best_pval = None
-                for pval in pvals:
+                pval_distances = tree.get_distances(marker[1], [x[1] for x in pvals])
+                for pval, temp_distance in zip(pvals, pval_distances):
                     if pval[1] in [y for (x, y) in pheno_assocs]:
                         continue
-                    temp_distance = nx.shortest_path_length(
-                        graph, source=marker[1], target=pval[1])
+                    if temp_distance is None:
+                        continue
                     if not best_pval_distance or temp_distance < best_pval_distance:
-                        best_pval = nx.shortest_path(
-                            graph, source=marker[1], target=pval[1])[-1]
+                        best_pval = pval[1]
                         best_pval_distance = temp_distance
                     else:
                         continue
@@ -670,12 +897,12 @@ class Interpreter:
                 for pair in pheno_assocs:
                     best_pheno_distance = None
                     best_pheno = None
-                    for phenotype in phenotypes:
-                        temp_distance = nx.shortest_path_length(
-                            graph, target=phenotype[1], source=pair[0])
+                    pheno_distances = tree.get_distances(pair[0], [x[1] for x in phenotypes])
+                    for phenotype, temp_distance in zip(phenotypes, pheno_distances):
+                        if temp_distance is None:
+                            continue
                         if not best_pheno_distance or temp_distance < best_pheno_distance:
-                            best_pheno = nx.shortest_path(
-                                graph, target=phenotype[1], source=pair[0])[-1]
+                            best_pheno = phenotype[1]
                             best_pheno_distance = temp_distance
                         else:
                             continue
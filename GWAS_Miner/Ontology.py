@@ -1,10 +1,18 @@
 import logging
+import os
 import pickle
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+from itertools import islice
 
-from py2neo import Graph
 from DataStructures import Lexicon, LexiconEntry, MasterLexicon
 
 logger = logging.getLogger("GWAS Miner")
+lexicon_cache = "../ontology_data/lexicon.lexi"
+lexicon_store = "../ontology_data/lexicon.db"
+# Number of ontology rows retrieved and added to the lexicon between progress updates.
+import_page_size = 10000
 
 
 def validate_data(ont_data):
@@ -19,22 +27,53 @@ def validate_data(ont_data):
     return True
 
 
-def set_master_lexicon():
-    master = get_graph_ontology_data()
+def set_master_lexicon(qt_progress_signal=None, mesh_file=None, hpo_file=None):
+    master = get_graph_ontology_data(qt_progress_signal, mesh_file, hpo_file)
     try:
-        with open("../ontology_data/lexicon.lexi", "wb") as file:
+        # Write to a temporary file first so that a partially written cache is never loaded.
+        with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(lexicon_cache), delete=False) as file:
             pickle.dump(master, file)
+        os.replace(file.name, lexicon_cache)
     except IOError as io:
         logger.error(F"Unable to create lexicon cache: {io}")
     except Exception as ex:
         logger.error(F"An unexpected error occurred creating lexicon cache: {ex}")
+    if os.path.exists(lexicon_store):
+        set_master_lexicon_store(master)
     return master
 
 
+def set_master_lexicon_store(master):
+    from LexiconStore import write_lexicon_store
+    try:
+        write_lexicon_store(master, lexicon_store)
+    except Exception as ex:
+        logger.error(F"Unable to create lexicon store: {ex}")
+
+
+def get_master_lexicon_store():
+    """
+    Retrieve the master lexicon from the indexed lexicon store, creating the store from the lexicon cache if missing.
+    @return: MasterLexicon object containing StoredLexicon objects.
+    """
+    from LexiconStore import load_lexicon_store
+    if not os.path.exists(lexicon_store):
+        logger.info(F"Lexicon store missing, creating new store...")
+        master = get_master_lexicon()
+        if not master:
+            return None
+        set_master_lexicon_store(master)
+    try:
+        return load_lexicon_store(lexicon_store)
+    except Exception as ex:
+        logger.error(F"An unexpected error occurred reading lexicon store: {ex}")
+    return None
+
+
 def get_master_lexicon():
     master = None
     try:
-        with open("../ontology_data/lexicon.lexi", "rb") as file:
+        with open(lexicon_cache, "rb") as file:
             master = pickle.load(file)
     except FileNotFoundError:
         logger.info(F"Cache missing, creating new cache...")
@@ -46,11 +85,15 @@ def get_master_lexicon():
     return master
 
 
-def update_ontology_cache(qt_progress_signal=None, qt_finished_signal=None):
+def update_ontology_cache(qt_progress_signal=None, qt_finished_signal=None, mesh_file=None, hpo_file=None):
     """[Updates the ontology cache files with data from the source ontology files.]
+
+    Args:
+        mesh_file ([string], optional): [MeSH descriptor XML dump used instead of the Neo4j server]. Defaults to None.
+        hpo_file ([string], optional): [HPO OBO file used instead of the Neo4j server]. Defaults to None.
     """
     logger.info("Updating ontology cache.")
-    set_master_lexicon()
+    set_master_lexicon(qt_progress_signal, mesh_file, hpo_file)
     # get_graph_ontology_data()
     logger.info("Finished updating ontology cache.")
     if qt_finished_signal:
@@ -59,11 +102,22 @@ def update_ontology_cache(qt_progress_signal=None, qt_finished_signal=None):
         qt_finished_signal.emit(response)
 
 
-def get_graph_ontology_data():
+def get_graph_ontology_data(qt_progress_signal=None, mesh_file=None, hpo_file=None):
+    """
+    Build the master lexicon from the Neo4j server, or from the exported ontology files where provided.
+    @param qt_progress_signal: (Optional) Signal used to report import progress to the GUI.
+    @param mesh_file: (Optional) MeSH descriptor XML dump used in place of the Neo4j server.
+    @param hpo_file: (Optional) HPO OBO file used in place of the Neo4j server.
+    @return: MasterLexicon object.
+    """
     ontologies = ["MESH", "HPO"]
+    ontology_files = {"MESH": mesh_file, "HPO": hpo_file}
     master_lexi = MasterLexicon()
     for ont in ontologies:
-        lexi = __retrieve_ont_lexicon(ont)
+        if ontology_files[ont]:
+            lexi = __retrieve_file_lexicon(ont, ontology_files[ont], qt_progress_signal)
+        else:
+            lexi = __retrieve_ont_lexicon(ont, qt_progress_signal)
         master_lexi.add_lexicon(lexi)
     return master_lexi
 
@@ -74,7 +128,48 @@ def output_lexicon_terms(lexi):
             fout.write(", ".join(entry.tree_id()) + "\t" + entry.identifier + "\t" + entry.name() + "\n")
 
 
-def __retrieve_ont_lexicon(ontology_name):
+def __report_import_progress(qt_progress_signal, ontology_name, row_count, start_time, finished=False):
+    elapsed = time.time() - start_time
+    rate = row_count / elapsed if elapsed > 0 else row_count
+    message = F"{'Imported' if finished else 'Importing'} {ontology_name}: {row_count} rows ({rate:.0f} rows/s)"
+    logger.info(message)
+    if qt_progress_signal:
+        qt_progress_signal.emit(message)
+
+
+def __build_lexicon(ontology_name, rows, qt_progress_signal=None):
+    """
+    Build a lexicon from a stream of ontology rows, a page of rows at a time.
+    @param ontology_name: Name of the ontology e.g. MESH
+    @param rows: Iterable of (id, name, tree id, synonyms) rows.
+    @param qt_progress_signal: (Optional) Signal used to report import progress to the GUI.
+    @return: Lexicon object.
+    """
+    lexi = Lexicon(name=ontology_name)
+    rows = iter(rows)
+    row_count = 0
+    start_time = time.time()
+    page = list(islice(rows, import_page_size))
+    while page:
+        for row in page:
+            old_entry = lexi.get_entry_by_term(str(row[1]))
+            if old_entry:
+                if ontology_name == "MESH":
+                    old_entry.add_tree_id(str(row[2]))
+                continue
+            entry = LexiconEntry(str(row[0]), name=str(row[1]), tree_id=str(row[2]))
+            for syn in row[3]:
+                entry.add_synonym(id=entry.identifier, name=syn)
+            lexi.add_entry(entry)
+        row_count += len(page)
+        __report_import_progress(qt_progress_signal, ontology_name, row_count, start_time)
+        page = list(islice(rows, import_page_size))
+    __report_import_progress(qt_progress_signal, ontology_name, row_count, start_time, finished=True)
+    return lexi
+
+
+def __retrieve_ont_lexicon(ontology_name, qt_progress_signal=None):
+    from py2neo import Graph
     try:
         graph = Graph(scheme="bolt", host="localhost", password="12345")
         ont_query = ""
@@ -100,18 +195,74 @@ def __retrieve_ont_lexicon(ontology_name):
             WITH n, COLLECT(m.FSN) AS syns
             RETURN n.id, n.FSN, n.treeid, syns
             """
+        # The cursor streams records from the server, which are consumed a page at a time.
         cursor = graph.run(ont_query)
-        lexi = Lexicon(name=ontology_name)
-        while cursor.forward():
-            old_entry = lexi.get_entry_by_term(str(cursor.current[1]))
-            if old_entry:
-                if ontology_name == "MESH":
-                    old_entry.add_tree_id(str(cursor.current[2]))
-                continue
-            entry = LexiconEntry(str(cursor.current[0]), name=str(cursor.current[1]), tree_id=str(cursor.current[2]))
-            for syn in cursor.current[3]:
-                entry.add_synonym(id=entry.identifier, name=syn)
-            lexi.add_entry(entry)
-        return lexi
+        return __build_lexicon(ontology_name, cursor, qt_progress_signal)
     except ConnectionRefusedError as cre:
         raise cre
+
+
+def __retrieve_file_lexicon(ontology_name, file_input, qt_progress_signal=None):
+    if ontology_name == "MESH":
+        rows = __read_mesh_xml(file_input)
+    else:
+        rows = __read_obo(file_input)
+    return __build_lexicon(ontology_name, rows, qt_progress_signal)
+
+
+def __read_mesh_xml(file_input):
+    """
+    Stream the descriptor records from a MeSH XML dump (e.g. desc2023.xml), yielding a row per tree number.
+    The miner_included flags held in the Neo4j database are not part of the dump, so every descriptor is included.
+    @param file_input: File path of the MeSH descriptor XML file.
+    @return: Generator of (id, name, tree id, synonyms) rows.
+    """
+    context = ElementTree.iterparse(file_input, events=("start", "end"))
+    root = None
+    for event, elem in context:
+        if event == "start":
+            if root is None:
+                root = elem
+            continue
+        if elem.tag != "DescriptorRecord":
+            continue
+        identifier = elem.findtext("DescriptorUI")
+        name = elem.findtext("DescriptorName/String")
+        synonyms = [name]
+        for term in elem.iterfind("ConceptList/Concept/TermList/Term/String"):
+            if term.text not in synonyms:
+                synonyms.append(term.text)
+        tree_ids = [x.text for x in elem.iterfind("TreeNumberList/TreeNumber")] or [None]
+        for tree_id in tree_ids:
+            yield identifier, name, tree_id, synonyms
+        # Release parsed records to keep memory use bounded.
+        elem.clear()
+        root.clear()
+
+
+def __read_obo(file_input):
+    """
+    Stream the term stanzas from an OBO file (e.g. hp.obo), skipping obsolete terms.
+    @param file_input: File path of the OBO file.
+    @return: Generator of (id, name, tree id, synonyms) rows.
+    """
+    term = None
+    with open(file_input, "r", encoding="utf-8") as fin:
+        for line in fin:
+            line = line.strip()
+            if line.startswith("["):
+                if term and term["id"] and term["name"] and not term["obsolete"]:
+                    yield term["id"], term["name"], None, [term["name"]] + term["synonyms"]
+                term = {"id": None, "name": None, "synonyms": [], "obsolete": False} if line == "[Term]" else None
+            elif term is not None and ": " in line:
+                tag, value = line.split(": ", 1)
+                if tag == "id":
+                    term["id"] = value
+                elif tag == "name":
+                    term["name"] = value
+                elif tag == "synonym" and value.startswith('"'):
+                    term["synonyms"].append(value[1:value.index('"', 1)])
+                elif tag == "is_obsolete" and value == "true":
+                    term["obsolete"] = True
+    if term and term["id"] and term["name"] and not term["obsolete"]:
+        yield term["id"], term["name"], None, [term["name"]] + term["synonyms"]
@@ -5,6 +5,8 @@
 
 #### Write a BioC collection in JSON
 import json
+from contextlib import ExitStack
+from xml.sax.saxutils import XMLGenerator
 
 import bioc
 
@@ -157,14 +159,230 @@ class JSON2BioC:
         return collection
 
 
+class BioCJSONWriter:
+    """
+    Write BioC collections to a JSON file one document and passage at a time, producing the same layout as
+    json.dump with the given indent.
+    """
+
+    def __init__(self, fp, indent=4, ensure_ascii=True):
+        self.fp = fp
+        self.indent = indent
+        self.__encoder = json.JSONEncoder(indent=indent, ensure_ascii=ensure_ascii)
+        self.__open_objects = []
+
+    def __encode(self, value, level):
+        # Encoded strings never contain raw newlines, so every newline is indentation to be shifted to this level.
+        return self.__encoder.encode(BioC.to_builtin(value)).replace("\n", "\n" + " " * (self.indent * level))
+
+    def __start_object(self, obj, list_key):
+        level = len(self.__open_objects) * 2
+        keys = list(obj.keys())
+        position = keys.index(list_key) if list_key in keys else len(keys)
+        self.fp.write("{")
+        for i in range(position):
+            self.fp.write(F"{',' if i else ''}\n{' ' * (self.indent * (level + 1))}"
+                          F"{self.__encoder.encode(keys[i])}: {self.__encode(obj[keys[i]], level + 1)}")
+        if position < len(keys):
+            self.fp.write(F"{',' if position else ''}\n{' ' * (self.indent * (level + 1))}"
+                          F"{self.__encoder.encode(list_key)}: [")
+        self.__open_objects.append([obj, keys, position, False])
+
+    def __start_item(self):
+        state = self.__open_objects[-1]
+        level = len(self.__open_objects) * 2
+        self.fp.write(F"{',' if state[3] else ''}\n{' ' * (self.indent * level)}")
+        state[3] = True
+
+    def __end_object(self):
+        obj, keys, position, has_items = self.__open_objects.pop()
+        level = len(self.__open_objects) * 2
+        if position < len(keys):
+            # Keys following the list may have been added while the list was being written.
+            keys = list(obj.keys())
+            self.fp.write(F"\n{' ' * (self.indent * (level + 1))}]" if has_items else "]")
+        for i in range(position + 1, len(keys)):
+            self.fp.write(F",\n{' ' * (self.indent * (level + 1))}"
+                          F"{self.__encoder.encode(keys[i])}: {self.__encode(obj[keys[i]], level + 1)}")
+        self.fp.write(F"\n{' ' * (self.indent * level)}}}" if keys else "}")
+
+    def start_collection(self, collection):
+        self.__start_object(collection, "documents")
+
+    def start_document(self, document):
+        self.__start_item()
+        self.__start_object(document, "passages")
+
+    def write_passage(self, passage):
+        self.__start_item()
+        self.fp.write(self.__encode(passage, len(self.__open_objects) * 2))
+
+    def write_document(self, document):
+        """
+        Write a complete document within the current collection.
+        @param document: BioC document dictionary.
+        """
+        self.__start_item()
+        self.fp.write(self.__encode(document, len(self.__open_objects) * 2))
+
+    def end_document(self, document):
+        self.__end_object()
+
+    def end_collection(self, collection):
+        self.__end_object()
+
+
+class BioCXMLWriter:
+    """
+    Write BioC collections to a BioC XML file one document and passage at a time.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.__xml = XMLGenerator(fp, encoding="utf-8", short_empty_elements=True)
+        self.__level = 0
+
+    @staticmethod
+    def __get(obj, name):
+        return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+    @staticmethod
+    def __text(value):
+        return "" if value is None else str(value)
+
+    def __newline(self):
+        self.__xml.ignorableWhitespace("\n" + "  " * self.__level)
+
+    def __start(self, name, attrs=None):
+        self.__newline()
+        self.__xml.startElement(name, attrs or {})
+        self.__level += 1
+
+    def __end(self, name):
+        self.__level -= 1
+        self.__newline()
+        self.__xml.endElement(name)
+
+    def __element(self, name, text=None, attrs=None):
+        self.__newline()
+        self.__xml.startElement(name, attrs or {})
+        if text:
+            self.__xml.characters(text)
+        self.__xml.endElement(name)
+
+    def __infons(self, infons):
+        if isinstance(infons, dict):
+            for key, value in infons.items():
+                self.__element("infon", self.__text(value), {"key": self.__text(key)})
+
+    def __relation(self, relation):
+        self.__start("relation", {"id": self.__text(self.__get(relation, "id"))})
+        self.__infons(self.__get(relation, "infons"))
+        for node in self.__get(relation, "nodes") or []:
+            self.__element("node", attrs={"refid": self.__text(self.__get(node, "refid")),
+                                          "role": self.__text(self.__get(node, "role"))})
+        self.__end("relation")
+
+    def __annotation(self, annotation):
+        self.__start("annotation", {"id": self.__text(self.__get(annotation, "id"))})
+        self.__infons(self.__get(annotation, "infons"))
+        for location in self.__get(annotation, "locations") or []:
+            self.__element("location", attrs={"offset": self.__text(self.__get(location, "offset")),
+                                              "length": self.__text(self.__get(location, "length"))})
+        self.__element("text", self.__text(self.__get(annotation, "text")))
+        self.__end("annotation")
+
+    def __annotated_element(self, element):
+        for annotation in self.__get(element, "annotations") or []:
+            self.__annotation(annotation)
+        for relation in self.__get(element, "relations") or []:
+            self.__relation(relation)
+
+    def start_collection(self, collection):
+        self.__xml.startDocument()
+        self.fp.write("<!DOCTYPE collection SYSTEM 'BioC.dtd'>")
+        self.__level = 0
+        self.__start("collection")
+        for name in ["source", "date", "key"]:
+            self.__element(name, self.__text(collection.get(name)))
+        self.__infons(collection.get("infons"))
+
+    def start_document(self, document):
+        self.__start("document")
+        self.__element("id", self.__text(document.get("id")))
+        self.__infons(document.get("infons"))
+
+    def write_passage(self, passage):
+        self.__start("passage")
+        self.__infons(self.__get(passage, "infons"))
+        self.__element("offset", self.__text(self.__get(passage, "offset")))
+        if self.__get(passage, "text") is not None:
+            self.__element("text", self.__text(self.__get(passage, "text")))
+        for sentence in self.__get(passage, "sentences") or []:
+            self.__start("sentence")
+            self.__infons(self.__get(sentence, "infons"))
+            self.__element("offset", self.__text(self.__get(sentence, "offset")))
+            self.__element("text", self.__text(self.__get(sentence, "text")))
+            self.__annotated_element(sentence)
+            self.__end("sentence")
+        self.__annotated_element(passage)
+        self.__end("passage")
+
+    def end_document(self, document):
+        self.__annotated_element(document)
+        self.__end("document")
+
+    def end_collection(self, collection):
+        self.__end("collection")
+        self.__xml.endDocument()
+        self.fp.write("\n")
+
+
+def write_bioc(collection, writers):
+    """
+    Walk a BioC collection once, passing each document and passage to every writer in turn.
+    @param collection: BioC collection dictionary, which may contain BioC annotation and relation objects.
+    @param writers: List of BioCJSONWriter/BioCXMLWriter objects.
+    """
+    for writer in writers:
+        writer.start_collection(collection)
+    for document in collection.get("documents", []):
+        for writer in writers:
+            writer.start_document(document)
+        for passage in document.get("passages", []):
+            for writer in writers:
+                writer.write_passage(passage)
+        for writer in writers:
+            writer.end_document(document)
+    for writer in writers:
+        writer.end_collection(collection)
+
+
 def output_xml(in_file, out_file):
-    bioc_json = json.loads(in_file)
-    json2bioc = JSON2BioC()
-    bioc_collection = json2bioc.collection(bioc_json)
+    output_bioc_xml(json.loads(in_file), out_file)
+
+
+def output_bioc_xml(study, out_file):
     with open(out_file, "w", encoding="UTF-8") as fout:
-        bioc.dump(bioc_collection, fout)
+        write_bioc(study, [BioCXMLWriter(fout)])
 
 
 def output_json(study, out_file):
     with open(out_file, "w", encoding="UTF-8") as fout:
-        json.dump(study, fout, default=BioC.ComplexHandler, indent=4)
+        write_bioc(study, [BioCJSONWriter(fout)])
+
+
+def output_study(study, json_file=None, xml_file=None):
+    """
+    Write a study to BioC JSON and/or BioC XML files using a single traversal of the study.
+    @param study: BioC collection dictionary.
+    @param json_file: Output path for the BioC JSON file, or None to skip JSON output.
+    @param xml_file: Output path for the BioC XML file, or None to skip XML output.
+    """
+    with ExitStack() as stack:
+        writers = []
+        if json_file:
+            writers.append(BioCJSONWriter(stack.enter_context(open(json_file, "w", encoding="UTF-8"))))
+        if xml_file:
+            writers.append(BioCXMLWriter(stack.enter_context(open(xml_file, "w", encoding="UTF-8"))))
+        write_bioc(study, writers)
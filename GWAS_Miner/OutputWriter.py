@@ -0,0 +1,70 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger("GWAS Miner")
+
+# Maximum number of write tasks waiting at once before submitting blocks the caller.
+max_pending_writes = 8
+
+
+class BackgroundWriter:
+    """
+    Run output writing tasks in submission order on a background thread, so that NLP processing can continue while
+    results are encoded and written to disk. The task queue is bounded; once it is full, submitting blocks until the
+    writer catches up.
+    """
+
+    def __init__(self, max_pending=max_pending_writes):
+        self.__queue = queue.Queue(maxsize=max_pending)
+        self.__thread = threading.Thread(target=self.__run, name="GWAS Miner output writer", daemon=True)
+        self.__closed = False
+        self.failed_tasks = 0
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __run(self):
+        while True:
+            task = self.__queue.get()
+            try:
+                if task is None:
+                    return
+                function, args, kwargs = task
+                function(*args, **kwargs)
+            except Exception as e:
+                self.failed_tasks += 1
+                logger.error(F"Unable to write output: {e}")
+            finally:
+                self.__queue.task_done()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue a writing task, blocking while the queue is full.
+        @param function: Function performing the write.
+        @param args: Positional arguments for the function.
+        @param kwargs: Keyword arguments for the function.
+        """
+        if self.__closed:
+            raise RuntimeError("Output writer has been closed.")
+        self.__queue.put((function, args, kwargs))
+
+    def flush(self):
+        """
+        Wait until every queued task has been written.
+        """
+        self.__queue.join()
+
+    def close(self):
+        """
+        Write any queued tasks and stop the writer thread.
+        """
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__queue.put(None)
+        self.__thread.join()
@@ -0,0 +1,67 @@
+import re
+from functools import lru_cache
+
+# Maximum number of distinct patterns and pattern groups kept compiled at once.
+pattern_cache_size = 1024
+# Back references are numbered relative to the whole expression, so patterns using them cannot be combined.
+back_reference_pattern = re.compile(r"\\[1-9]|\(\?P=")
+
+
+@lru_cache(maxsize=pattern_cache_size)
+def compile_pattern(pattern, ignore_case=True):
+    """
+    Compile a regex pattern once. Invalid patterns are matched literally instead.
+    @param pattern: Regex pattern string.
+    @param ignore_case: Compile the pattern with the IGNORECASE flag.
+    @return: Compiled regex object.
+    """
+    flags = re.IGNORECASE if ignore_case else 0
+    try:
+        return re.compile(pattern, flags)
+    except re.error:
+        return re.compile(re.escape(pattern), flags)
+
+
+@lru_cache(maxsize=pattern_cache_size)
+def compile_scans(patterns, ignore_case=True):
+    """
+    Compile a group of patterns sharing an entity label, along with a combined alternation of all of them. The
+    alternation finds a match if and only if at least one of the patterns matches somewhere, so texts it does not match
+    can skip the pattern scans. Patterns which cannot be combined leave the alternation as None.
+    @param patterns: Tuple of regex pattern strings, in priority order.
+    @param ignore_case: Compile the patterns with the IGNORECASE flag.
+    @return: Tuple of the combined regex (or None) and the tuple of compiled patterns.
+    """
+    compiled = tuple(compile_pattern(x, ignore_case) for x in patterns)
+    if len(compiled) < 2 or [x for x in compiled if back_reference_pattern.search(x.pattern)]:
+        return None, compiled
+    try:
+        combined = re.compile("|".join(F"(?:{x.pattern})" for x in compiled), re.IGNORECASE if ignore_case else 0)
+    except re.error:
+        return None, compiled
+    # Inline flags within a pattern would apply to the whole alternation.
+    if [x for x in compiled if x.flags != combined.flags]:
+        return None, compiled
+    return combined, compiled
+
+
+def find_spans(patterns, text, ignore_case=True):
+    """
+    Find the character spans matched by each pattern in the text. Patterns are scanned one after another in priority
+    order, so the spans of an earlier pattern are always produced before any overlapping spans of a later one. A
+    pattern containing more than one group contributes the span of its first group, otherwise the span of the whole
+    match.
+    @param patterns: Regex pattern string or list of pattern strings sharing an entity label, in priority order.
+    @param text: Text to search.
+    @param ignore_case: Match the patterns case insensitively.
+    @return: Generator of (pattern index, start, end) tuples.
+    """
+    if isinstance(patterns, str):
+        patterns = (patterns,)
+    combined, compiled = compile_scans(tuple(patterns), ignore_case)
+    if combined is not None and not combined.search(text):
+        return
+    for pattern_index, regex in enumerate(compiled):
+        for match in regex.finditer(text):
+            start, end = match.span(1) if regex.groups > 1 else match.span()
+            yield pattern_index, start, end
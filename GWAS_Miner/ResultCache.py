@@ -0,0 +1,100 @@
+import hashlib
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger("GWAS Miner")
+
+passage_cache = "cache/passages.db"
+# Increment when the stored document format changes to invalidate existing entries.
+passage_cache_version = 1
+
+
+def get_passage_key(text, fingerprint):
+    """
+    Calculate the content address of a passage.
+    @param text: Passage text.
+    @param fingerprint: Hash of the settings used to process the passage.
+    @return: Hex digest string.
+    """
+    digest = hashlib.sha1(F"{passage_cache_version}:{fingerprint}:".encode("utf-8"))
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class PassageCache:
+    """
+    Persistent cache of processed passages, addressed by passage text and processing settings. Parses hold the
+    serialized model output, keyed by the model settings, so that a lexicon or pattern change only repeats the
+    ontology and rule matching. Annotations hold the fully annotated document, keyed by every setting affecting the
+    entities found.
+    """
+
+    def __init__(self, file_path=passage_cache):
+        self.file_path = file_path
+        self.__connection = None
+        self.__pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_PassageCache__connection"] = None
+        state["_PassageCache__pid"] = None
+        return state
+
+    def __get_connection(self):
+        # Connections must not be shared with forked worker processes.
+        if self.__connection is None or self.__pid != os.getpid():
+            if os.path.dirname(self.file_path):
+                os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            self.__connection = sqlite3.connect(self.file_path, timeout=60)
+            self.__connection.execute("PRAGMA journal_mode = WAL")
+            # Entries are committed after every passage, losing the most recent ones on a power failure is harmless.
+            self.__connection.execute("PRAGMA synchronous = NORMAL")
+            self.__connection.executescript("""
+                CREATE TABLE IF NOT EXISTS parses (key TEXT PRIMARY KEY, data BLOB);
+                CREATE TABLE IF NOT EXISTS annotations (key TEXT PRIMARY KEY, data BLOB);
+            """)
+            self.__pid = os.getpid()
+        return self.__connection
+
+    def __get(self, table, key):
+        try:
+            row = self.__get_connection().execute(F"SELECT data FROM {table} WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.error(F"Unable to read from the passage cache: {e}")
+            return None
+        if row:
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def __set(self, table, key, data):
+        try:
+            self.__get_connection().execute(F"INSERT OR REPLACE INTO {table} VALUES (?, ?)", (key, data))
+        except sqlite3.Error as e:
+            logger.error(F"Unable to write to the passage cache: {e}")
+
+    def get_parse(self, key):
+        return self.__get("parses", key)
+
+    def set_parse(self, key, data):
+        self.__set("parses", key, data)
+
+    def get_annotation(self, key):
+        return self.__get("annotations", key)
+
+    def set_annotation(self, key, data):
+        self.__set("annotations", key, data)
+
+    def commit(self):
+        """
+        Write any pending cache entries to disk, releasing the write lock held since the first pending entry.
+        """
+        if self.__connection is not None and self.__pid == os.getpid():
+            try:
+                self.__connection.commit()
+            except sqlite3.Error as e:
+                logger.error(F"Unable to write to the passage cache: {e}")
@@ -1,35 +1,127 @@
 import json
 import logging
+import os
 import re
+import tempfile
 from datetime import datetime
 
+from spacy.tokens import Doc
+
 from Exceptions import TableTypeError
 import BioC
+import OutputConverter
 
 table_significance_pattern = r""
+# Tables files of at least this many bytes are read, annotated and written one table at a time.
+stream_min_file_size = 50 << 20
+# Characters which can continue a JSON number.
+number_tail_pattern = re.compile(r"[0-9eE.+\-]*")
+# Cells made up only of numbers, p-values, ranges and rsIDs, which do not need parsing by the model. Each character
+# can only start one of the alternatives and numbers must be matched whole, so a cell can only be split one way and
+# non-matching cells fail in linear time.
+structured_cell_pattern = re.compile(r"(?:rs\d+(?!\d)|\d+(?:[.·]\d+)?(?!\d)|[eE](?=[-−–+]?\d)|[×xX*^](?=\s*\d)|"
+                                     r"[\s()\[\]<>=≤≥±%,;:/+\-−–])*")
 
 
 def output_tables(destination, tables):
+    """
+    Write annotated tables to a BioC JSON file.
+    @param destination: Output file path.
+    @param tables: BioC collection dictionary of the tables.
+    @return: True if the file was written, otherwise False.
+    """
     try:
         with open(destination, "w", encoding="utf-8") as fout:
             json.dump(tables, fout, default=ComplexHandler, ensure_ascii=False, indent=4)
+        return True
     except IOError as ie:
         print(F"IO Error occurred: {ie}")
     except Exception as e:
         print(F"An unknown error occurred: {e}")
-
-
-def process_tables(nlp, tables):
-    t, m, p, r = 0, 0, 0, 0
+    return False
+
+
+def add_spacy_docs(nlp, tables, batch_size=64, n_process=1):
+    """
+    Process the text of every table element across all of the tables in batched passes, setting the type of each
+    table from its heading docs before its data cells are processed. Repeated texts are only processed once, with each
+    further element receiving its own copy of the resulting doc.
+    @param nlp: Interpreter object used for NLP processing.
+    @param tables: List of Table objects.
+    @param batch_size: Number of texts passed through the model at once.
+    @param n_process: Number of processes used by the model.
+    @return: Interpreter object.
+    """
+    # Table types only depend on the titles, captions, footers, sections and column headings, so data cells are only
+    # processed for tables which have a type and will have annotations extracted.
+    __process_spacy_targets(nlp, [x for table in tables for x in table.get_spacy_targets(data_cells=False)],
+                            batch_size, n_process)
+    for table in tables:
+        table.set_table_type()
+    __process_spacy_targets(nlp, [x for table in tables if table.table_type for x in table.get_data_cell_targets()],
+                            batch_size, n_process)
+    return nlp
+
+
+def __process_spacy_targets(nlp, targets, batch_size, n_process):
+    """
+    Process the text of each table element, assigning the resulting doc to the element.
+    @param nlp: Interpreter object used for NLP processing.
+    @param targets: List of (element, attribute name, text) tuples.
+    @param batch_size: Number of texts passed through the model at once.
+    @param n_process: Number of processes used by the model.
+    """
+    unique_texts = {}
+    for element, attribute, text in targets:
+        unique_texts.setdefault(text, None)
+    # Only free text is parsed by the model, structured cells are tokenized and matched directly.
+    structured_texts = [x for x in unique_texts if is_structured_cell(x)]
+    free_texts = [x for x in unique_texts if not is_structured_cell(x)]
+    for text, doc in zip(structured_texts, nlp.annotate_tokens(structured_texts)):
+        unique_texts[text] = doc
+    for text, doc in zip(free_texts, nlp.process_corpora(free_texts, batch_size=batch_size, n_process=n_process)):
+        unique_texts[text] = doc
+    # Cell annotation adds entities to the docs, so elements sharing a text are each given their own copy.
+    doc_bytes = {}
+    for element, attribute, text in targets:
+        doc = unique_texts[text]
+        if text in doc_bytes:
+            doc = Doc(doc.vocab).from_bytes(doc_bytes[text])
+        elif doc is not None:
+            doc_bytes[text] = doc.to_bytes()
+        setattr(element, attribute, doc)
+
+
+def is_structured_cell(text):
+    """
+    Check whether a table cell only contains numbers, p-values, ranges or rsIDs.
+    @param text: Cell text.
+    @return: True if the cell text is structured.
+    """
+    return structured_cell_pattern.fullmatch(text) is not None
+
+
+def process_tables(nlp, tables, n_process=1, counters=None):
+    """
+    Annotate each of the tables.
+    @param nlp: Interpreter object used for NLP processing.
+    @param tables: List of Table objects.
+    @param n_process: Number of processes used by the model.
+    @param counters: List of the trait, marker, p-value and relation identifier counters to continue from, which is
+    updated in place. Counters start from 0 if not provided.
+    @return: Tuple of the annotated tables and the Interpreter object.
+    """
+    if counters is None:
+        counters = [0, 0, 0, 0]
+    nlp = add_spacy_docs(nlp, tables, n_process=n_process)
     for table in tables:
-        nlp = table.add_spacy_docs(nlp)
         table.annotations = nlp.annotations
         table.relations = nlp.relations
         nlp.annotations = []
         nlp.relations = []
         if table.table_type:
             try:
-                t, m, p, r = table.assign_annotations(t, m, p, r)
+                counters[:] = table.assign_annotations(*counters)
             except TableTypeError as tte:
                 logging.error(F"Failed to interpret table type correctly - Table {table.table_id}")
     return tables, nlp
@@ -65,7 +157,170 @@ def get_cell_entity_annotation(nlp, ent, table_element, cell_id, element_offset=
     return annotation, nlp
 
 
-def parse_tables(file_input, nlp):
+def iter_collection_documents(fin, collection, chunk_size=1 << 20):
+    """
+    Incrementally read a BioC JSON collection, yielding one document at a time so that only a single document is held
+    in memory. Other top level values are added to the collection dictionary as they are read.
+    @param fin: Text file object positioned at the start of the collection.
+    @param collection: Dictionary which receives the top level values of the collection, with documents left empty.
+    @param chunk_size: Number of characters read from the file at once.
+    @return: Generator of document dictionaries.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof = "", 0, False
+
+    def next_character():
+        nonlocal buffer, position, eof
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer) or eof:
+                return buffer[position] if position < len(buffer) else ""
+            buffer, position = fin.read(chunk_size), 0
+            eof = not buffer
+
+    def next_value():
+        nonlocal buffer, position, eof
+        next_character()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+                # A number followed only by number characters up to the buffer end, such as "1.5e", may continue in
+                # the next chunk.
+                if eof or type(value) not in (int, float) or not number_tail_pattern.fullmatch(buffer, end):
+                    position = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            # Read at least as much again as is buffered, so large values are only re-decoded a few times.
+            chunk = fin.read(max(chunk_size, len(buffer) - position))
+            buffer, position, eof = buffer[position:] + chunk, 0, not chunk
+
+    def expect(characters):
+        nonlocal position
+        character = next_character()
+        if not character or character not in characters:
+            raise json.JSONDecodeError(F"Expected one of '{characters}'", buffer, position)
+        position += 1
+        return character
+
+    expect("{")
+    if next_character() == "}":
+        return
+    while True:
+        key = next_value()
+        expect(":")
+        if key == "documents":
+            collection[key] = []
+            expect("[")
+            if next_character() == "]":
+                position += 1
+            else:
+                while True:
+                    yield next_value()
+                    if expect(",]") == "]":
+                        break
+        else:
+            collection[key] = next_value()
+        if expect(",}") == "}":
+            return
+
+
+def __parse_table_document(doc, file_input):
+    """
+    Build a Table object from a BioC table document.
+    @param doc: BioC document dictionary for a single table.
+    @param file_input: Path of the tables file, used for reporting.
+    @return: Table object.
+    """
+    table_id = doc['id']
+    title = None
+    title_offset = None
+    caption = None
+    caption_offset = None
+    content_offset = None
+    columns = []
+    table_sections = []
+    footer = None
+    footer_offset = None
+    doc['annotations'] = []
+    for passage in doc['passages']:
+        if "section_title_2" in passage['infons'].keys():
+            print(F"Second table title found in: {file_input}")
+        if passage['infons']['section_title_1'] == 'table_title':
+            title = passage['text']
+            title_offset = passage['offset']
+        elif passage['infons']['section_title_1'] == 'table_caption':
+            caption = passage['text']
+            caption_offset = passage['offset']
+        elif passage['infons']['section_title_1'] == 'table_footer':
+            footer = passage['text']
+            footer_offset = passage['offset']
+        elif passage['infons']['section_title_1'] == 'table_content':
+            content_offset = passage['offset']
+            col_row = TableRow()
+            for col in passage['column_headings']:
+                column_cell = TableCell(col['cell_id'], str(col['cell_text']))
+                col_row.cells.append(column_cell)
+            columns.append(col_row)
+            for section in passage['data_section']:
+                table_section = TableSection(title=section['table_section_title_1'])
+                for row in section['data_rows']:
+                    data_row = TableRow()
+                    for cell in row:
+                        data_cell = TableCell(cell['cell_id'], str(cell['cell_text']))
+                        data_row.cells.append(data_cell)
+                    if abs(len(data_row.cells) - len(columns[0].cells)) > 1:
+                        print(F"{file_input} contains potentially problematic cell counts!")
+                    table_section.rows.append(data_row)
+                table_sections.append(table_section)
+
+    return Table(title, table_id, title_offset, content_offset, columns,
+                 table_sections, caption, caption_offset, footer, footer_offset)
+
+
+def __get_table_splices(document_ids, table_annotations):
+    """
+    Work out where table annotations are written within a BioC tables collection. The annotations of a table are
+    written to the first document with its id, and passage relations are cleared on every document up to the last one
+    receiving annotations, or on every document if the document of an annotated table is not found.
+    @param document_ids: List of the document ids, in collection order.
+    @param table_annotations: List of (table id, annotations, relations) tuples for the annotated tables.
+    @return: Tuple of a dictionary of document index -> (annotations, relations) and the index of the last document
+    with passage relations cleared.
+    """
+    document_indexes = {}
+    for i, document_id in enumerate(document_ids):
+        document_indexes.setdefault(document_id, i)
+    splices = {}
+    last_index = -1
+    for table_id, annotations, relations in table_annotations:
+        i = document_indexes.get(table_id)
+        if i is None:
+            last_index = len(document_ids) - 1
+            continue
+        splices[i] = (annotations, relations)
+        last_index = max(last_index, i)
+    return splices, last_index
+
+
+def __splice_table_document(doc, index, splices, last_index):
+    """
+    Write the annotations of a table into its BioC document, as planned by __get_table_splices.
+    @param doc: BioC document dictionary.
+    @param index: Index of the document within the collection.
+    @param splices: Dictionary of document index -> (annotations, relations).
+    @param last_index: Index of the last document with passage relations cleared.
+    """
+    if index in splices:
+        doc["annotations"], doc["relations"] = splices[index]
+    if index <= last_index:
+        for passage in doc["passages"]:
+            passage["relations"] = []
+
+
+def parse_tables(file_input, nlp, n_process=1):
     tables = []
     tables_data = None
     contains_annotations = False
@@ -73,65 +328,17 @@ def parse_tables(file_input, nlp):
         with open(file_input, "r", encoding="utf-8") as fin:
             tables_data = json.load(fin)
         for doc in tables_data["documents"]:  # each doc is a table
-            table_id = doc['id']
-            title = None
-            title_offset = None
-            caption = None
-            caption_offset = None
-            content_offset = None
-            columns = []
-            table_sections = []
-            footer = None
-            footer_offset = None
-            doc['annotations'] = []
-            for passage in doc['passages']:
-                if "section_title_2" in passage['infons'].keys():
-                    print(F"Second table title found in: {file_input}")
-                if passage['infons']['section_title_1'] == 'table_title':
-                    title = passage['text']
-                    title_offset = passage['offset']
-                elif passage['infons']['section_title_1'] == 'table_caption':
-                    caption = passage['text']
-                    caption_offset = passage['offset']
-                elif passage['infons']['section_title_1'] == 'table_footer':
-                    footer = passage['text']
-                    footer_offset = passage['offset']
-                elif passage['infons']['section_title_1'] == 'table_content':
-                    content_offset = passage['offset']
-                    col_row = TableRow()
-                    for col in passage['column_headings']:
-                        column_cell = TableCell(col['cell_id'], str(col['cell_text']))
-                        col_row.cells.append(column_cell)
-                    columns.append(col_row)
-                    for section in passage['data_section']:
-                        table_section = TableSection(title=section['table_section_title_1'])
-                        for row in section['data_rows']:
-                            data_row = TableRow()
-                            for cell in row:
-                                data_cell = TableCell(cell['cell_id'], str(cell['cell_text']))
-                                data_row.cells.append(data_cell)
-                            if abs(len(data_row.cells) - len(columns[0].cells)) > 1:
-                                print(F"{file_input} contains potentially problematic cell counts!")
-                            table_section.rows.append(data_row)
-                        table_sections.append(table_section)
-
-            table = Table(title, table_id, title_offset, content_offset, columns,
-                          table_sections, caption, caption_offset, footer, footer_offset)
-            tables.append(table)
+            tables.append(__parse_table_document(doc, file_input))
     except IOError as ie:
         print(F"No tables file found for {file_input.replace('_tables.json', '')}")
     if tables_data:
-        annotated_tables, nlp = process_tables(nlp, tables)
-        for table in annotated_tables:
-            if table.annotations:
-                contains_annotations = True
-                for bioc_table in tables_data["documents"]:
-                    for passage in bioc_table["passages"]:
-                        passage["relations"] = []
-                    if bioc_table["id"] == table.table_id:
-                        bioc_table["annotations"] = table.annotations
-                        bioc_table["relations"] = table.relations
-                        break
+        annotated_tables, nlp = process_tables(nlp, tables, n_process)
+        documents = tables_data["documents"]
+        table_annotations = [(x.table_id, x.annotations, x.relations) for x in annotated_tables if x.annotations]
+        contains_annotations = bool(table_annotations)
+        splices, last_index = __get_table_splices([x["id"] for x in documents], table_annotations)
+        for i, bioc_table in enumerate(documents):
+            __splice_table_document(bioc_table, i, splices, last_index)
 
     # if contains_annotations:
     #     print(F"Table(s) have annotation(s) in: {file_input}")
@@ -142,6 +349,57 @@ def parse_tables(file_input, nlp):
     return tables_data, contains_annotations
 
 
+def stream_tables(file_input, destination, nlp, n_process=1):
+    """
+    Annotate a tables file one table at a time, so memory use is bounded by the largest table rather than the whole
+    file. Only the annotations are kept while the tables are annotated. The file is then read again and each table is
+    written to the output with its annotations spliced in as by parse_tables. The output is written to a temporary
+    file which only replaces the destination if annotations were found.
+    @param file_input: Path of the tables file.
+    @param destination: Output file path.
+    @param nlp: Interpreter object used for NLP processing.
+    @param n_process: Number of processes used by the model.
+    @return: Tuple of the number of tables read (None if the file could not be read) and whether annotations were found.
+    """
+    document_ids = []
+    table_annotations = []
+    counters = [0, 0, 0, 0]
+    temp_path = None
+    try:
+        with open(file_input, "r", encoding="utf-8") as fin:
+            for doc in iter_collection_documents(fin, {}):
+                table = __parse_table_document(doc, file_input)
+                process_tables(nlp, [table], n_process, counters)
+                document_ids.append(doc["id"])
+                if table.annotations:
+                    table_annotations.append((table.table_id, table.annotations, table.relations))
+        if table_annotations:
+            splices, last_index = __get_table_splices(document_ids, table_annotations)
+            collection = {}
+            with open(file_input, "r", encoding="utf-8") as fin, \
+                    tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(destination) or ".",
+                                                suffix=".tmp", delete=False) as fout:
+                temp_path = fout.name
+                writer = None
+                for i, doc in enumerate(iter_collection_documents(fin, collection)):
+                    if writer is None:
+                        writer = OutputConverter.BioCJSONWriter(fout, ensure_ascii=False)
+                        writer.start_collection(collection)
+                    # Every table document is given empty annotations when parsed.
+                    doc["annotations"] = []
+                    __splice_table_document(doc, i, splices, last_index)
+                    writer.write_document(doc)
+                writer.end_collection(collection)
+            os.replace(temp_path, destination)
+    except IOError as ie:
+        print(F"No tables file found for {file_input.replace('_tables.json', '')}")
+        return None, False
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+    return len(document_ids), bool(table_annotations)
+
+
 class Table:
     # Table contains a list of variants and significances for a single trait
     TYPE_MARKER_LIST = 1
@@ -196,7 +454,10 @@ class Table:
         self.section_ents = []
         self.passages = []
 
-    def __set_table_type(self):
+    def set_table_type(self):
+        """
+        Identify the table type from the entities found in the table's spaCy docs.
+        """
         # Check column types
         self.contains_marker, self.contains_trait, self.contains_pval = False, False, False
         if self.title_doc:
@@ -286,27 +547,47 @@ class Table:
         elif self.contains_significance and self.contains_marker:
             self.table_type = Table.TYPE_MARKER_LIST
 
-    def add_spacy_docs(self, nlp):
+    def get_spacy_targets(self, data_cells=True):
+        """
+        Retrieve each table element requiring NLP processing.
+        @param data_cells: Include the cells of the table's data rows.
+        @return: List of (element, attribute name, text) tuples, the processed doc is assigned to the attribute.
+        """
+        targets = []
         if self.caption_text:
-            self.caption_doc = nlp.process_corpus(self.caption_text, )
+            targets.append((self, "caption_doc", self.caption_text))
         if self.footer_text:
-            self.footer_doc = nlp.process_corpus(self.footer_text, )
+            targets.append((self, "footer_doc", self.footer_text))
         if self.title:
             if isinstance(self.title, list):
                 self.title = self.title[0]
-            self.title_doc = nlp.process_corpus(self.title, )
+            targets.append((self, "title_doc", self.title))
         if self.column_rows:
             for row in self.column_rows:
                 for cell in row.cells:
-                    cell.add_spacy_docs(nlp)
+                    if cell.text:
+                        targets.append((cell, "doc", cell.text))
+        if self.data_sections:
+            for section in self.data_sections:
+                if section.title:
+                    targets.append((section, "doc", section.title))
+        if data_cells:
+            targets += self.get_data_cell_targets()
+        return targets
+
+    def get_data_cell_targets(self):
+        """
+        Retrieve each data row cell requiring NLP processing.
+        @return: List of (cell, attribute name, text) tuples, the processed doc is assigned to the attribute.
+        """
+        targets = []
         if self.data_sections:
             for section in self.data_sections:
-                section.add_spacy_docs(nlp)
                 for row in section.rows:
                     for cell in row.cells:
-                        cell.add_spacy_docs(nlp)
-        self.__set_table_type()
-        return nlp
+                        if cell.text:
+                            targets.append((cell, "doc", cell.text))
+        return targets
 
     def __get_cell_annotation(self, cell, col_type, t, m, p):
         annotation = None
@@ -499,10 +780,6 @@ class TableSection:
         self.title_offset = title_offset
         self.doc = None
 
-    def add_spacy_docs(self, nlp):
-        if self.title:
-            self.doc = nlp.process_corpus(self.title, )
-
     def jsonable(self):
         output_dict = self.__dict__
         del output_dict['doc']
@@ -525,10 +802,6 @@ class TableCell:
         self.text = text
         self.doc = None
 
-    def add_spacy_docs(self, nlp):
-        if self.text:
-            self.doc = nlp.process_corpus(self.text, )
-
     def jsonable(self):
         output_dict = self.__dict__
         del output_dict['doc']
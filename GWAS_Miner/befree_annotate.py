@@ -1,5 +1,8 @@
 import html
+import json
+import os
 import re
+from collections import Counter
 from datetime import datetime
 from difflib import SequenceMatcher
 
@@ -8,45 +11,156 @@ from GWAS_Miner.BioC import BioCLocation, BioCAnnotation
 from Utility_Functions import Utility
 
 
+befree_variant_file = "vdas_version_2+mesh.tsv"
+befree_gene_file = "gdas_version_1+mesh.tsv"
+__befree_indexes = {}
+
+
+def build_befree_index(file_input):
+    """
+    Create an index of the byte offsets of each PMID's rows within a BeFree TSV file. The index is saved alongside the
+    TSV file and is rebuilt whenever the TSV file changes.
+    @param file_input: File path of the BeFree TSV file.
+    @return: Dictionary of PMID -> list of row byte offsets.
+    """
+    file_stats = os.stat(file_input)
+    index = {}
+    with open(file_input, "rb") as f_in:
+        f_in.readline()  # skip headers
+        offset = f_in.tell()
+        for line in f_in:
+            pmid = line[:line.find(b"\t")].decode("utf-8")
+            index.setdefault(pmid, []).append(offset)
+            offset += len(line)
+    try:
+        with open(F"{file_input}.idx", "w", encoding="utf-8") as f_out:
+            json.dump({"size": file_stats.st_size, "modified": file_stats.st_mtime, "offsets": index}, f_out)
+    except IOError as io:
+        print(F"Unable to save BeFree index for {file_input}: {io}")
+    return index
+
+
+def get_befree_index(file_input):
+    """
+    Retrieve the PMID index for a BeFree TSV file, loading or building it once per process.
+    @param file_input: File path of the BeFree TSV file.
+    @return: Dictionary of PMID -> list of row byte offsets.
+    """
+    if file_input in __befree_indexes:
+        return __befree_indexes[file_input]
+    index = None
+    file_stats = os.stat(file_input)
+    try:
+        with open(F"{file_input}.idx", "r", encoding="utf-8") as f_in:
+            saved_index = json.load(f_in)
+        if saved_index["size"] == file_stats.st_size and saved_index["modified"] == file_stats.st_mtime:
+            index = saved_index["offsets"]
+    except (IOError, ValueError, KeyError):
+        pass
+    if index is None:
+        index = build_befree_index(file_input)
+    __befree_indexes[file_input] = index
+    return index
+
+
+def get_befree_rows(file_input, pmid):
+    """
+    Retrieve only the rows of a BeFree TSV file belonging to the given PMID.
+    @param file_input: File path of the BeFree TSV file.
+    @param pmid: PMID to retrieve rows for.
+    @return: List of rows, each split into a list of column values.
+    """
+    rows = []
+    offsets = get_befree_index(file_input).get(pmid)
+    if not offsets:
+        return rows
+    with open(file_input, "rb") as f_in:
+        for offset in offsets:
+            f_in.seek(offset)
+            rows.append(f_in.readline().decode("utf-8").split("\t"))
+    return rows
+
+
 def get_befree_data(pmid):
     befree_data = {}
-    headers_skipped = False
     # retrieve befree variants
-    with open("vdas_version_2+mesh.tsv", "r", encoding="utf-8") as f_in:
-        for line in f_in.readlines():
-            if not headers_skipped:
-                headers_skipped = not headers_skipped
-                continue
-            line = line.split("\t")
-            if line[0] != pmid:
-                continue
-            if line[0] not in befree_data.keys():
-                befree_data[line[0]] = []
-            befree_data[line[0]].append({"sentence_number": line[3], "variantid": line[4], "variant_offset": line[6],
-                                         "diseaseid": line[7], "disease_text": line[8], "disease_offset": line[9],
-                                         "sentence": html.unescape(line[10].lstrip('"').rstrip('"')),
-                                         "meshid": line[11],
-                                         "mapping_source": line[13]})
+    for line in get_befree_rows(befree_variant_file, pmid):
+        if line[0] not in befree_data.keys():
+            befree_data[line[0]] = []
+        befree_data[line[0]].append({"sentence_number": line[3], "variantid": line[4], "variant_offset": line[6],
+                                     "diseaseid": line[7], "disease_text": line[8], "disease_offset": line[9],
+                                     "sentence": html.unescape(line[10].lstrip('"').rstrip('"')),
+                                     "meshid": line[11],
+                                     "mapping_source": line[13]})
     # retrieve befree genes
-    with open("gdas_version_1+mesh.tsv", "r", encoding="utf-8") as f_in:
-        for line in f_in.readlines():
-            if not headers_skipped:
-                headers_skipped = not headers_skipped
-                continue
-            line = line.split("\t")
-            if line[0] != pmid:
-                continue
-            if line[0] not in befree_data.keys():
-                befree_data[line[0]] = []
-            befree_data[line[0]].append({"sentence_number": line[3], "ncbi_id": line[4], "gene_offset": line[6],
-                                         "gene_text": line[5],
-                                         "diseaseid": line[7], "disease_text": line[8], "disease_offset": line[9],
-                                         "sentence": html.unescape(line[10].lstrip('"').rstrip('"')),
-                                         "meshid": line[11],
-                                         "mapping_source": line[13]})
+    for line in get_befree_rows(befree_gene_file, pmid):
+        if line[0] not in befree_data.keys():
+            befree_data[line[0]] = []
+        befree_data[line[0]].append({"sentence_number": line[3], "ncbi_id": line[4], "gene_offset": line[6],
+                                     "gene_text": line[5],
+                                     "diseaseid": line[7], "disease_text": line[8], "disease_offset": line[9],
+                                     "sentence": html.unescape(line[10].lstrip('"').rstrip('"')),
+                                     "meshid": line[11],
+                                     "mapping_source": line[13]})
     return befree_data
 
 
+class SentenceAligner:
+    """
+    Index of the sentences within a passage, used to find the sentence most similar to a BeFree sentence without
+    comparing it against every sentence of the passage.
+    """
+    shingle_size = 4  # Length of the character n-grams used to shortlist candidate sentences.
+    candidate_count = 10  # Number of shortlisted sentences given a full similarity comparison.
+
+    def __init__(self, text):
+        self.sentences = text.split(". ")
+        self.__exact_matches = {}
+        self.__shingles = {}
+        self.__results = {}
+        for i in range(len(self.sentences)):
+            self.__exact_matches.setdefault(self.sentences[i], i)
+            for shingle in SentenceAligner.__get_shingles(self.sentences[i]):
+                self.__shingles.setdefault(shingle, set()).add(i)
+
+    @staticmethod
+    def __get_shingles(text):
+        text = text.lower()
+        size = SentenceAligner.shingle_size
+        return {text[i:i + size] for i in range(max(len(text) - size + 1, 1))}
+
+    def best_match(self, sentence, threshold=0.7):
+        """
+        Find the passage sentence most similar to the input sentence.
+        @param sentence: Sentence text to align, e.g. a BeFree sentence.
+        @param threshold: Minimum similarity ratio accepted.
+        @return: Tuple of the similarity ratio and passage sentence, or (0, None) if no sentence reaches the threshold.
+        """
+        if sentence in self.__results:
+            return self.__results[sentence]
+        result = (0, None)
+        if sentence and sentence in self.__exact_matches:
+            result = (1.0, self.sentences[self.__exact_matches[sentence]])
+        else:
+            overlaps = Counter()
+            for shingle in SentenceAligner.__get_shingles(sentence):
+                overlaps.update(self.__shingles.get(shingle, ()))
+            candidates = sorted(overlaps.items(), key=lambda x: (-x[1], x[0]))[:SentenceAligner.candidate_count]
+            matcher = SequenceMatcher(None)
+            matcher.set_seq2(sentence)
+            for i, overlap in sorted(candidates):
+                matcher.set_seq1(self.sentences[i])
+                # Cheap upper bounds on the ratio rule out most candidates before the full comparison.
+                if matcher.real_quick_ratio() < max(threshold, result[0]) or \
+                        matcher.quick_ratio() < max(threshold, result[0]):
+                    continue
+                score = matcher.ratio()
+                if score >= threshold and score > result[0]:
+                    result = (score, self.sentences[i])
+        self.__results[sentence] = result
+        return result
+
+
 def get_bioc_annotations(annotations, offset, nlp):
     current_datetime = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
     for annot in annotations:
@@ -134,15 +248,13 @@ def get_befree_strict_annotations(study, nlp, current_datetime):
                                                                          "discussion", "conclusion"]:
                 continue
             text = passage["text"]
+            aligner = SentenceAligner(text)
             for entry in study_befree_data:
                 disease_node_id, marker_node_id, gene_node_id = nlp.t, nlp.v, nlp.g
                 used_variant_ident, used_disease_ident, used_gene_ident = False, False, False
                 closest_gene_index, closest_variant_index, closest_disease_index = False, False, False
                 is_gene = "ncbi_id" in entry.keys()
-                sent = sorted([(SequenceMatcher(None, x, entry['sentence']).ratio(), x) for x in text.split(". ")],
-                              key=lambda y: y[0], reverse=True)[0]
-                sent_score = sent[0]
-                sent = sent[1]
+                sent_score, sent = aligner.best_match(entry['sentence'])
                 if not sent or sent_score < 0.7:
                     continue
                 sentence_offset = text.index(sent) + passage["offset"]
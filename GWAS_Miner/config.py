@@ -105,3 +105,12 @@ pheno_assoc_patterns = [
         }
     ]
 ]
+
+# Table Variables
+# Columns with more body cells than this are typed from a sample of their rows, 0 = always test every cell.
+table_sample_min_rows = 5000
+# Number of rows included in a column sample.
+table_sample_size = 500
+# Z score of the confidence interval which must lie entirely on one side of the column type threshold, otherwise
+# every cell in the column is tested.
+table_sample_z_score = 2.576
@@ -16,7 +16,6 @@ setuptools.setup(
     install_requires=[
        "python-dateutil>=2.8.1",
        "jsonschema>=3.2.0",
-       "networkx>=2.5",
        "spacy>=3.2.1",
        "en_core_sci_scibert @ https://s3-us-west-2.amazonaws.com/ai2-s2-scispacy/releases/v0.5.0/en_core_sci_scibert-0.5.0.tar.gz",
        "svglib>=1.0.1",
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Modules within GWAS_Miner import each other both by module name and through the GWAS_Miner package.
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(root, "GWAS_Miner"), root]
@@ -0,0 +1,13 @@
+import json
+
+import BioC
+
+
+def test_passage_output_omits_text():
+    passage = BioC.BioCPassage(infons={"section_title_1": "results"}, offset=10, text="rs123 was associated",
+                               annotations=[BioC.BioCAnnotation(id="M1", text="rs123",
+                                                                locations=[BioC.BioCLocation(offset=10, length=5)])],
+                               relations=[])
+    output = BioC.to_builtin(passage)
+    assert list(output.keys()) == ["infons", "offset", "sentences", "annotations", "relations"]
+    assert json.loads(json.dumps(output))["annotations"][0]["text"] == "rs123"
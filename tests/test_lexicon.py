@@ -0,0 +1,23 @@
+import pickle
+
+from DataStructures import Lexicon, LexiconEntry
+
+
+def create_lexicon():
+    lexicon = Lexicon("HPO")
+    for i in range(50):
+        entry = LexiconEntry(F"HP:{i}", F"Phenotype {i}", tree_id=F"A{i}")
+        entry.add_synonym(F"S{i}", F"Synonym {i}")
+        lexicon.add_entry(entry)
+    return lexicon
+
+
+def test_pickled_lexicon_omits_and_rebuilds_indexes():
+    lexicon = create_lexicon()
+    state = lexicon.__getstate__()
+    assert "_Lexicon__identifiers" not in state and "_Lexicon__terms" not in state
+    restored = pickle.loads(pickle.dumps(lexicon))
+    assert restored.get_entry_by_id("HP:7").name() == "Phenotype 7"
+    assert restored.get_entry_by_term("synonym 12").identifier == "HP:12"
+    assert restored.identifier_used("HP:49")
+    assert [x.identifier for x in restored.get_entries()] == [x.identifier for x in lexicon.get_entries()]
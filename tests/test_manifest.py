@@ -0,0 +1,54 @@
+import json
+import os
+import sqlite3
+
+import Manifest
+
+
+def create_study(tmp_path):
+    input_file = tmp_path / "PMC1_bioc.json"
+    input_file.write_text("{}", encoding="utf-8")
+    output_file = tmp_path / "PMC1_result.json"
+    output_file.write_text("{}", encoding="utf-8")
+    return str(input_file), str(output_file)
+
+
+def test_unchanged_study_is_current(tmp_path):
+    input_file, output_file = create_study(tmp_path)
+    manifest_file = str(tmp_path / "manifest.db")
+    Manifest.StudyManifest("1", "json", manifest_file).record(input_file, "complete", [output_file])
+    manifest = Manifest.StudyManifest("1", "json", manifest_file)
+    assert manifest.is_current(input_file)
+    assert manifest.get_pending_files(str(tmp_path), ["PMC1_bioc.json"]) == []
+
+
+def test_switching_output_format_processes_studies_again(tmp_path):
+    input_file, output_file = create_study(tmp_path)
+    manifest_file = str(tmp_path / "manifest.db")
+    Manifest.StudyManifest("1", "json", manifest_file).record(input_file, "complete", [output_file])
+    manifest = Manifest.StudyManifest("1", "xml", manifest_file)
+    assert not manifest.is_current(input_file)
+    assert manifest.get_pending_files(str(tmp_path), ["PMC1_bioc.json"]) == ["PMC1_bioc.json"]
+
+
+def test_missing_output_processes_study_again(tmp_path):
+    input_file, output_file = create_study(tmp_path)
+    manifest = Manifest.StudyManifest("1", "json", str(tmp_path / "manifest.db"))
+    manifest.record(input_file, "complete", [output_file])
+    os.remove(output_file)
+    assert not manifest.is_current(input_file)
+
+
+def test_rows_without_an_output_format_are_not_current(tmp_path):
+    input_file, output_file = create_study(tmp_path)
+    manifest_file = str(tmp_path / "manifest.db")
+    connection = sqlite3.connect(manifest_file)
+    connection.execute("CREATE TABLE studies (file_name TEXT PRIMARY KEY, file_hash TEXT, tool_version TEXT, "
+                       "lexicon_version TEXT, outputs TEXT, status TEXT, updated_at TEXT)")
+    manifest = Manifest.StudyManifest("1", "json", manifest_file)
+    connection.execute("INSERT INTO studies VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       ("PMC1_bioc.json", manifest.get_file_hash(input_file), Manifest.tool_version, "1",
+                        json.dumps([output_file]), "complete", ""))
+    connection.commit()
+    connection.close()
+    assert not manifest.is_current(input_file)
@@ -0,0 +1,40 @@
+import re
+
+import config
+import PatternRegistry
+
+
+def sequential_spans(patterns, text, ignore_case=True):
+    # Scans each pattern separately, in order, as entities were originally matched.
+    flags = re.IGNORECASE if ignore_case else 0
+    for i, pattern in enumerate(patterns):
+        try:
+            matches = list(re.finditer(pattern, text, flags))
+        except re.error:
+            matches = list(re.finditer(re.escape(pattern), text, flags))
+        for match in matches:
+            start, end = match.span(1) if len(match.groups()) > 1 else match.span()
+            yield i, start, end
+
+
+def test_overlapping_patterns_match_the_sequential_scan():
+    patterns = ["b+c", "ab", "a"]
+    for text in ["abbc ab", "ABC", "xyz", "cab abc bc"]:
+        assert list(PatternRegistry.find_spans(patterns, text)) == list(sequential_spans(patterns, text))
+
+
+def test_pval_patterns_match_the_sequential_scan():
+    patterns = config.regex_entity_patterns["PVAL"]
+    texts = ["Associated with BMI (P = 5 × 10-8) and height (p-value=1.2×10−5).",
+             "rs123 reached p<2.3 x 10 -12, rs456 p = 0.04",
+             "P value 3 × 10(-6)",
+             "No significance values here."]
+    for text in texts:
+        assert list(PatternRegistry.find_spans(patterns, text)) == list(sequential_spans(patterns, text))
+
+
+def test_case_sensitive_and_invalid_patterns_match_the_sequential_scan():
+    patterns = ["BMI", "a(b", r"(\w)\1"]
+    for text in ["BMI bmi a(b aa", "bmi"]:
+        assert list(PatternRegistry.find_spans(patterns, text, False)) == \
+               list(sequential_spans(patterns, text, False))
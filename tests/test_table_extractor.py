@@ -0,0 +1,87 @@
+import io
+import json
+import time
+
+import TableExtractor
+
+
+def test_structured_cells():
+    for text in ["0.05", "1.2 × 10-8", "3e-5", "rs123456", "12 (10-14)", "<0.001", "1,234", "2·3×10−4"]:
+        assert TableExtractor.is_structured_cell(text), text
+    for text in ["BMI", "n/a", "1.2.3", "rs12.5", "0.05 (adjusted)"]:
+        assert not TableExtractor.is_structured_cell(text), text
+
+
+def test_structured_cell_pattern_does_not_backtrack():
+    cells = ["123456789 123456789 123456789 n/a",
+             "123456789 " * 200 + "n/a",
+             "1,2.3 " * 2000 + "n/a",
+             "1.5 × 10-8; " * 1000 + "."]
+    start = time.perf_counter()
+    for text in cells:
+        assert not TableExtractor.is_structured_cell(text)
+    assert time.perf_counter() - start < 1
+
+
+def read_collection(text, chunk_size):
+    collection = {}
+    documents = list(TableExtractor.iter_collection_documents(io.StringIO(text), collection, chunk_size))
+    if "documents" in collection:
+        collection["documents"] = documents
+    return collection
+
+
+def test_iter_collection_documents_matches_json_load():
+    collections = [
+        '{"a": 1.5e10, "documents": [{"x": 12345}], "b": [1,2]}',
+        '{"documents": []}',
+        '{}',
+        '{"source": "PMC", "date": -0.25E-3, "key": 7, "infons": {}, "documents": [1e5, -12, 0.5, true, null]}',
+        json.dumps({"source": "Auto-CORPus", "documents": [{"id": "1", "passages": [{"offset": 0, "text": "p < 5×10−8",
+                                                                                    "infons": {}}]},
+                                                           {"id": "2", "passages": []}], "count": 12345678},
+                   indent=4, ensure_ascii=False),
+    ]
+    for text in collections:
+        expected = json.load(io.StringIO(text))
+        for chunk_size in [1, 2, 3, 5, 7, 64]:
+            assert read_collection(text, chunk_size) == expected, (text, chunk_size)
+
+
+def create_table_document(table_id):
+    return {"id": table_id, "infons": {}, "annotations": [], "relations": [{"id": "R0"}],
+            "passages": [{"offset": 0, "infons": {"section_title_1": "table_title"}, "text": F"Table {table_id}",
+                          "annotations": [], "relations": [{"id": "R1"}]},
+                         {"offset": 10, "infons": {"section_title_1": "table_content"}, "annotations": [],
+                          "relations": [{"id": "R2"}], "column_headings": [{"cell_id": "1", "cell_text": "SNP"}],
+                          "data_section": [{"table_section_title_1": "",
+                                            "data_rows": [[{"cell_id": "2", "cell_text": "rs123"}]]}]}]}
+
+
+def annotate_tables(annotated_ids):
+    def process_tables(nlp, tables, n_process=1, counters=None):
+        for table in tables:
+            table.annotations = [{"id": F"M{table.table_id}"}] if table.table_id in annotated_ids else []
+            table.relations = [{"id": F"R{table.table_id}"}] if table.table_id in annotated_ids else []
+        return tables, nlp
+    return process_tables
+
+
+def test_stream_tables_matches_parse_tables(tmp_path, monkeypatch):
+    collection = {"source": "Auto-CORPus", "date": "20220101", "key": "autocorpus_tables.key", "infons": {},
+                  "documents": [create_table_document(x) for x in ["1", "2", "3", "2", "4"]]}
+    input_file = tmp_path / "PMC1_tables.json"
+    input_file.write_text(json.dumps(collection, indent=4), encoding="utf-8")
+    for annotated_ids in [{"2"}, {"3"}, {"1", "4"}, set()]:
+        monkeypatch.setattr(TableExtractor, "process_tables", annotate_tables(annotated_ids))
+        parsed_file, streamed_file = tmp_path / "parsed.json", tmp_path / "streamed.json"
+        for x in [parsed_file, streamed_file]:
+            if x.exists():
+                x.unlink()
+        tables, contains_annotations = TableExtractor.parse_tables(str(input_file), None)
+        if contains_annotations:
+            TableExtractor.output_tables(str(parsed_file), tables)
+        assert TableExtractor.stream_tables(str(input_file), str(streamed_file), None) == (5, contains_annotations)
+        assert streamed_file.exists() == parsed_file.exists()
+        if contains_annotations:
+            assert streamed_file.read_text(encoding="utf-8") == parsed_file.read_text(encoding="utf-8")